@@ -0,0 +1,537 @@
+# benchmark.py
+# 下载性能基准：
+#   transport - 对同一组镜像分别用不同的传输方式拉取全部 blob，比较耗时与连接复用情况
+#   registry  - 启动本地模拟镜像仓库（令牌认证、清单、blob、Range 请求，可注入延迟/带宽/断流）
+#   suite     - 对模拟仓库端到端执行 清单解析 → 下载 → 打包 → 清单缓存再验证，按阶段统计耗时、吞吐、
+#               峰值内存与磁盘写入，并与基线结果比较，发现性能回退
+import os
+import io
+import ssl
+import sys
+import json
+import time
+import gzip
+import random
+import shutil
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from docker_pull import core as puller
+
+FAKE_TOKEN = "benchmark-token"
+SEND_CHUNK = 64 * 1024
+PHASES = ("resolve", "download", "build", "revalidate")
+MIN_REGRESSION_SECONDS = 0.05
+
+def run_transport(args, transport):
+    # 令牌只在各自会话内缓存，两种传输都完整走一遍认证
+    session = puller.create_session(
+        None,
+        puller.pool_size_for(args.workers, args.segment_workers),
+        transport
+    )
+    session.verify = not args.insecure
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{transport}_")
+    try:
+        start = time.time()
+        resolved = [puller.resolve_image(session, args.registry, image, args.arch) for image in args.images]
+        resolve_time = time.time() - start
+
+        jobs = {}
+        for image in resolved:
+            for blob in image['manifest']['layers'] + [image['manifest']['config']]:
+                jobs.setdefault(blob['digest'], (image['repo'], image['img'], blob))
+        total_bytes = sum(blob.get('size', 0) for _, _, blob in jobs.values())
+
+        start = time.time()
+        # 只测网络传输，层保持压缩不解压
+        puller.download_layer_jobs(
+            session, args.registry, list(jobs.values()), work_dir,
+            workers=args.workers,
+            segment_size=args.segment_size,
+            segment_workers=args.segment_workers,
+            decompress=False
+        )
+        download_time = time.time() - start
+        return {
+            'transport': transport,
+            'resolve': resolve_time,
+            'download': download_time,
+            'blobs': len(jobs),
+            'bytes': total_bytes,
+            'connections': puller.connection_report(session)
+        }
+    finally:
+        session.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def report(results):
+    print(f"{'传输':<8}{'清单解析(s)':>12}{'下载(s)':>10}{'blob数':>8}{'MB/s':>10}")
+    for result in results:
+        mb_per_s = result['bytes'] / 1024 / 1024 / result['download'] if result['download'] else 0.0
+        print(f"{result['transport']:<8}{result['resolve']:>12.2f}{result['download']:>10.2f}"
+              f"{result['blobs']:>8}{mb_per_s:>10.1f}")
+    for result in results:
+        print(f"[{result['transport']}] {result['connections']}")
+
+def synthetic_layer(index, size, seed=0):
+    # 每 4K 块一半随机一半为零，压缩率约 2:1，接近常见镜像层
+    rng = random.Random(seed * 1000003 + index)
+    data = bytearray()
+    while len(data) < size:
+        data += rng.randbytes(2048) + bytes(2048)
+    data = bytes(data[:size])
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode='w') as tar:
+        info = tarfile.TarInfo(f"layer{index}/data.bin")
+        info.size = len(data)
+        info.mtime = 0
+        tar.addfile(info, io.BytesIO(data))
+    return raw.getvalue()
+
+def synthetic_image(layer_count, layer_size, seed=0):
+    # 返回 (blobs, manifest)；blobs 以摘要为键
+    def digest(data):
+        return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+    blobs = {}
+    descriptors = []
+    diff_ids = []
+    for index in range(layer_count):
+        raw = synthetic_layer(index, layer_size, seed)
+        compressed = gzip.compress(raw, mtime=0)
+        blobs[digest(compressed)] = compressed
+        diff_ids.append(digest(raw))
+        descriptors.append({
+            "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+            "digest": digest(compressed),
+            "size": len(compressed)
+        })
+    config = json.dumps({
+        "architecture": "amd64",
+        "os": "linux",
+        "config": {"Cmd": ["/bin/sh"]},
+        "rootfs": {"type": "layers", "diff_ids": diff_ids}
+    }).encode()
+    blobs[digest(config)] = config
+    manifest = json.dumps({
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        "config": {
+            "mediaType": "application/vnd.docker.container.image.v1+json",
+            "digest": digest(config),
+            "size": len(config)
+        },
+        "layers": descriptors
+    }).encode()
+    return blobs, manifest
+
+# 模拟镜像仓库：任意仓库名/标签都返回同一个合成镜像
+class FakeRegistry(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, blobs, manifest, latency=0.0, bandwidth=0, error_rate=0.0):
+        super().__init__(address, FakeRegistryHandler)
+        self.blobs = blobs
+        self.manifest = manifest
+        self.manifest_digest = f"sha256:{hashlib.sha256(manifest).hexdigest()}"
+        self.latency = latency
+        # 带宽上限由所有连接共享
+        self.limiter = puller.RateLimiter(bandwidth) if bandwidth else None
+        self.error_rate = error_rate
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+
+    def should_drop(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def handle_error(self, request, client_address):
+        # 客户端中途断开（如中断下载）属于正常情况，不输出异常堆栈
+        if isinstance(sys.exc_info()[1], (ConnectionError, ssl.SSLError)):
+            return
+        super().handle_error(request, client_address)
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        registry = self.server
+        if registry.latency:
+            time.sleep(registry.latency)
+        path = self.path.split('?', 1)[0]
+        if path == "/token":
+            return self._send(200, json.dumps({"token": FAKE_TOKEN, "expires_in": 300}).encode(),
+                              {"Content-Type": "application/json"})
+        if self.headers.get("Authorization") != f"Bearer {FAKE_TOKEN}":
+            host = self.headers.get("Host")
+            return self._send(401, b'{"errors":[{"code":"UNAUTHORIZED"}]}', {
+                "Www-Authenticate": f'Bearer realm="https://{host}/token",service="fake-registry"'
+            })
+        if path == "/v2/":
+            return self._send(200, b"{}")
+        if "/manifests/" in path:
+            etag = f'"{registry.manifest_digest}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, b"", {"ETag": etag})
+            return self._send(200, registry.manifest, {
+                "Content-Type": "application/vnd.docker.distribution.manifest.v2+json",
+                "Docker-Content-Digest": registry.manifest_digest,
+                "ETag": etag
+            })
+        if "/blobs/" in path:
+            blob = registry.blobs.get(path.rsplit('/', 1)[1])
+            if blob is None:
+                return self._send(404, b'{"errors":[{"code":"BLOB_UNKNOWN"}]}')
+            return self._send_blob(blob)
+        return self._send(404, b"")
+
+    def _send_blob(self, blob):
+        status, start, end = 200, 0, len(blob) - 1
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            first, _, last = byte_range[6:].partition('-')
+            start = int(first)
+            end = min(int(last), len(blob) - 1) if last else len(blob) - 1
+            if start >= len(blob):
+                return self._send(416, b"", {"Content-Range": f"bytes */{len(blob)}"})
+            status = 206
+        headers = {"Content-Type": "application/octet-stream", "Accept-Ranges": "bytes"}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(blob)}"
+        self._send(status, blob[start:end + 1], headers, drop=self.server.should_drop())
+
+    def _send(self, status, body, headers=None, drop=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # 注入的断流在发送一半数据后关闭连接，用于测量重试与续传的开销
+        limit = len(body) // 2 if drop else len(body)
+        view = memoryview(body)
+        for offset in range(0, limit, SEND_CHUNK):
+            chunk = view[offset:min(offset + SEND_CHUNK, limit)]
+            if self.server.limiter is not None:
+                self.server.limiter.consume(len(chunk))
+            self.wfile.write(chunk)
+        if drop:
+            self.close_connection = True
+
+def self_signed_cert(directory):
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert
+    ], check=True, capture_output=True)
+    return cert, key
+
+def serve_registry(args):
+    blobs, manifest = synthetic_image(args.layers, args.layer_size, args.seed)
+    server = FakeRegistry(
+        (args.host, args.port), blobs, manifest, args.latency, args.bandwidth, args.error_rate
+    )
+    cert_dir = None
+    cert, key = args.cert, args.key
+    if not cert:
+        cert_dir = tempfile.mkdtemp(prefix="bench_cert_")
+        cert, key = self_signed_cert(cert_dir)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    # 第一行输出监听地址，供 suite 子进程方式启动时读取
+    print(f"LISTENING {args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if cert_dir:
+            shutil.rmtree(cert_dir, ignore_errors=True)
+
+def start_registry(args):
+    # 模拟仓库在独立进程中运行，不计入被测进程的内存与磁盘统计
+    command = [
+        sys.executable, os.path.abspath(__file__), "registry", "--port", "0",
+        "--layers", str(args.layers), "--layer-size", str(args.layer_size),
+        "--latency", str(args.latency), "--bandwidth", str(args.bandwidth),
+        "--error-rate", str(args.error_rate), "--seed", str(args.seed)
+    ]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if not line.startswith("LISTENING "):
+        proc.kill()
+        raise RuntimeError("模拟镜像仓库启动失败")
+    return proc, line.split()[1]
+
+# 阶段统计：Linux 上通过 /proc 读取峰值内存（每阶段开始前重置）与实际写入磁盘的字节数
+def _proc_value(path, key):
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+class PhaseMeter:
+    def __init__(self):
+        self.phases = {}
+
+    def measure(self, name, func, size=None):
+        try:
+            with open("/proc/self/clear_refs", 'w') as f:
+                f.write("5")
+        except OSError:
+            pass
+        written = _proc_value("/proc/self/io", "write_bytes:")
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        peak_rss = _proc_value("/proc/self/status", "VmHWM:")
+        after = _proc_value("/proc/self/io", "write_bytes:")
+        self.phases[name] = {
+            'seconds': elapsed,
+            'bytes': size(result) if callable(size) else size,
+            'peak_rss': peak_rss * 1024 if peak_rss is not None else None,
+            'disk_bytes': after - written if written is not None and after is not None else None
+        }
+        return result
+
+def run_suite_round(args, registry):
+    session = puller.create_session(
+        None,
+        puller.pool_size_for(args.workers, args.segment_workers),
+        args.transport
+    )
+    session.verify = False
+    work_dir = tempfile.mkdtemp(prefix="bench_suite_")
+    layers_dir = os.path.join(work_dir, "layers")
+    os.makedirs(layers_dir)
+    meter = PhaseMeter()
+    compressed = args.format in puller.COMPRESSED_FORMATS
+    manifest_cache = puller.ManifestCache(os.path.join(work_dir, "manifests"))
+    try:
+        image = meter.measure(
+            "resolve", lambda: puller.resolve_image(session, registry, args.image, "amd64", manifest_cache)
+        )
+        manifest = image['manifest']
+        blobs = manifest['layers'] + [manifest['config']]
+        jobs = [(image['repo'], image['img'], blob) for blob in blobs]
+        total_bytes = sum(blob['size'] for blob in blobs)
+        layer_index = puller.LayerIndex(layers_dir)
+        layer_index.set_order([layer['digest'] for layer in manifest['layers']])
+
+        if args.engine == "async":
+            download = lambda: puller.download_layer_jobs_async(
+                registry, jobs, layers_dir, layer_index,
+                concurrency=args.async_concurrency,
+                segment_size=args.segment_size,
+                decompress=not compressed,
+                token_manager=session.token_manager,
+                decompress_workers=args.decompress_workers,
+                verify=False
+            )
+        else:
+            download = lambda: puller.download_layer_jobs(
+                session, registry, jobs, layers_dir, layer_index,
+                workers=args.workers,
+                segment_size=args.segment_size,
+                segment_workers=args.segment_workers,
+                decompress=not compressed,
+                decompress_workers=args.decompress_workers
+            )
+        meter.measure("download", download, total_bytes)
+
+        output_path = os.path.join(work_dir, "image.tar")
+        meter.measure("build", lambda: puller.build_image(
+            output_path, layers_dir, image['repo'], image['img'], image['tag'], args.format,
+            layer_digests=[layer['digest'] for layer in manifest['layers']],
+            manifest_raw=image['manifest_raw'],
+            config_digest=manifest['config']['digest']
+        ), lambda _: os.path.getsize(output_path))
+
+        # 清单缓存已有该标签，再次解析应以 If-None-Match 条件请求得到 304，不再传输清单
+        meter.measure(
+            "revalidate", lambda: puller.resolve_image(session, registry, args.image, "amd64", manifest_cache)
+        )
+        if not manifest_cache.revalidations:
+            raise RuntimeError("清单缓存的条件请求未命中（未返回 304）")
+        return meter.phases
+    finally:
+        session.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def suite_config(args):
+    return {
+        'layers': args.layers,
+        'layer_size': args.layer_size,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'error_rate': args.error_rate,
+        'engine': args.engine,
+        'transport': args.transport,
+        'format': args.format,
+        'workers': args.workers,
+        'segment_size': args.segment_size,
+        'segment_workers': args.segment_workers,
+        'chunk_size': puller.CHUNK_SIZE
+    }
+
+def _format_size(value):
+    return "-" if value is None else f"{value / 1024 / 1024:.1f}"
+
+def suite_report(phases):
+    print(f"{'阶段':<10}{'耗时(s)':>10}{'MB/s':>10}{'峰值内存(MB)':>14}{'磁盘写入(MB)':>14}")
+    for name in PHASES:
+        phase = phases[name]
+        rate = (phase['bytes'] / 1024 / 1024 / phase['seconds']
+                if phase['bytes'] and phase['seconds'] else None)
+        print(f"{name:<10}{phase['seconds']:>10.3f}{'-' if rate is None else f'{rate:.1f}':>10}"
+              f"{_format_size(phase['peak_rss']):>14}{_format_size(phase['disk_bytes']):>14}")
+
+def find_regressions(phases, baseline, threshold):
+    # 耗时或峰值内存超过基线 (1 + threshold) 倍即视为回退；耗时差小于 MIN_REGRESSION_SECONDS 的视为测量噪声
+    regressions = []
+    for name in PHASES:
+        base = baseline.get('phases', {}).get(name)
+        if not base:
+            continue
+        for metric, label in (('seconds', "耗时"), ('peak_rss', "峰值内存")):
+            current, previous = phases[name][metric], base.get(metric)
+            if metric == 'seconds' and current is not None and previous and \
+                    current - previous < MIN_REGRESSION_SECONDS:
+                continue
+            if current is not None and previous and current > previous * (1 + threshold):
+                regressions.append(
+                    f"{name} 阶段{label}回退: {previous:.3f} -> {current:.3f}（+{(current / previous - 1) * 100:.0f}%）"
+                    if metric == 'seconds' else
+                    f"{name} 阶段{label}回退: {_format_size(previous)} MB -> {_format_size(current)} MB"
+                    f"（+{(current / previous - 1) * 100:.0f}%）"
+                )
+    return regressions
+
+def run_suite(args):
+    puller.logger.setLevel(puller.logging.DEBUG if args.debug else puller.logging.WARNING)
+    if args.chunk_size:
+        puller.CHUNK_SIZE = args.chunk_size
+    if args.format not in puller.COMPRESSED_FORMATS:
+        puller.set_gzip_backend(args.decompressor)
+
+    proc, registry = start_registry(args)
+    try:
+        rounds = [run_suite_round(args, registry) for _ in range(args.rounds)]
+    finally:
+        proc.terminate()
+        proc.wait()
+    # 每个阶段取最快一轮
+    phases = {name: min((r[name] for r in rounds), key=lambda phase: phase['seconds']) for name in PHASES}
+    suite_report(phases)
+
+    result = {'config': suite_config(args), 'phases': phases}
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('config') != result['config']:
+        print("警告: 基线的测试参数与本次不同，比较结果仅供参考")
+    regressions = find_regressions(phases, baseline, args.threshold)
+    for regression in regressions:
+        print(f"[回退] {regression}")
+    if not regressions:
+        print(f"未发现超过 {args.threshold * 100:.0f}% 的性能回退")
+    return 1 if regressions else 0
+
+def _add_registry_arguments(parser):
+    parser.add_argument("--layers", type=int, default=4, help="合成镜像的层数 (默认: %(default)s)")
+    parser.add_argument("--layer-size", type=puller.parse_size, default=puller.parse_size("32M"),
+                        help="每层解压后的大小，支持K/M/G后缀 (默认: 32M)")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的附加延迟（秒） (默认: %(default)s)")
+    parser.add_argument("--bandwidth", type=puller.parse_size, default=0,
+                        help="所有连接共享的带宽上限（字节/秒），0表示不限 (默认: 0)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="blob 响应中途断开连接的概率，0~1 (默认: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="合成数据的随机种子 (默认: %(default)s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="镜像下载性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    transport = subparsers.add_parser("transport", help="比较 HTTP/1.1 与 HTTP/2 传输（建议使用本地镜像仓库）")
+    transport.add_argument("images", nargs="+", help="要拉取的镜像，例如 alpine:latest")
+    transport.add_argument("-r", "--registry", default="localhost:5000", help="镜像仓库地址 (默认: %(default)s)")
+    transport.add_argument("-a", "--arch", default="amd64", help="目标架构 (默认: amd64)")
+    transport.add_argument("-j", "--workers", type=int, default=8, help="并发下载数 (默认: %(default)s)")
+    transport.add_argument("--segment-size", type=puller.parse_size, default=puller.SEGMENT_SIZE,
+                           help="分段大小 (默认: 16M)")
+    transport.add_argument("--segment-workers", type=int, default=1, help="单层并发分段数 (默认: %(default)s)")
+    transport.add_argument("--rounds", type=int, default=1, help="每种传输重复次数，取最快一轮 (默认: %(default)s)")
+    transport.add_argument("--insecure", action="store_true", help="跳过SSL证书验证")
+
+    registry = subparsers.add_parser("registry", help="启动本地模拟镜像仓库（HTTPS，自签名证书）")
+    _add_registry_arguments(registry)
+    registry.add_argument("--host", default="127.0.0.1", help="监听地址 (默认: %(default)s)")
+    registry.add_argument("--port", type=int, default=5000, help="监听端口，0表示随机端口 (默认: %(default)s)")
+    registry.add_argument("--cert", help="TLS 证书文件 (默认: 临时生成自签名证书，需要 openssl)")
+    registry.add_argument("--key", help="TLS 私钥文件")
+
+    suite = subparsers.add_parser("suite", help="对本地模拟仓库端到端测试 清单解析/下载/打包 各阶段")
+    _add_registry_arguments(suite)
+    suite.add_argument("--image", default="bench:latest", help="拉取的镜像名称 (默认: %(default)s)")
+    suite.add_argument("-f", "--format", choices=["docker", "synology", "oci", "docker-gz"], default="docker",
+                       help="打包格式 (默认: %(default)s)")
+    suite.add_argument("-j", "--workers", type=int, default=puller.MAX_WORKERS,
+                       help="并发下载数 (默认: %(default)s)")
+    suite.add_argument("--segment-size", type=puller.parse_size, default=puller.SEGMENT_SIZE,
+                       help="分段大小 (默认: 16M)")
+    suite.add_argument("--segment-workers", type=int, default=puller.SEGMENT_WORKERS,
+                       help="单层并发分段数 (默认: %(default)s)")
+    suite.add_argument("--chunk-size", type=puller.parse_size, default=0,
+                       help="覆盖读写块大小 CHUNK_SIZE，支持K/M/G后缀 (默认: 512K)")
+    suite.add_argument("--decompress-workers", type=int, default=None, help="解压线程数 (默认: CPU 核数)")
+    suite.add_argument("--decompressor", choices=["auto"] + puller.GZIP_BACKENDS, default="auto",
+                       help="gzip 解压后端 (默认: %(default)s)")
+    suite.add_argument("--engine", choices=["thread", "async"], default="thread",
+                       help="下载引擎 (默认: %(default)s)")
+    suite.add_argument("--transport", choices=["http1", "http2"], default="http1",
+                       help="线程池引擎的HTTP传输 (默认: %(default)s)")
+    suite.add_argument("--async-concurrency", type=int, default=puller.ASYNC_CONCURRENCY,
+                       help="异步引擎的最大并发请求数 (默认: %(default)s)")
+    suite.add_argument("--rounds", type=int, default=1, help="重复次数，每个阶段取最快一轮 (默认: %(default)s)")
+    suite.add_argument("--save", metavar="FILE", help="把结果保存为 JSON，可作为之后比较的基线")
+    suite.add_argument("--baseline", metavar="FILE", help="与基线结果比较，发现回退时退出码为 1")
+    suite.add_argument("--threshold", type=float, default=0.1,
+                       help="判定回退的幅度，0.1 表示慢 10%% 以上 (默认: %(default)s)")
+    suite.add_argument("--debug", action="store_true", help="输出下载日志")
+
+    args = parser.parse_args()
+    if getattr(args, 'segment_size', 1) <= 0:
+        parser.error("--segment-size 必须大于 0")
+    puller.setup_console()
+    if args.command == "registry":
+        serve_registry(args)
+    elif args.command == "suite":
+        return run_suite(args)
+    elif args.command == "transport":
+        results = []
+        for name in ("http1", "http2"):
+            rounds = [run_transport(args, name) for _ in range(args.rounds)]
+            results.append(min(rounds, key=lambda result: result['resolve'] + result['download']))
+        report(results)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+# docker_pull：Docker 镜像拉取工具的库接口，命令行入口见 cli.py（python -m docker_pull 或 main.py）
+from .core import (
+    VERSION,
+    PACKAGE_FORMATS,
+    Puller,
+    PullService,
+    BlobCache,
+    ManifestCache,
+    Telemetry,
+    create_telemetry,
+    create_server,
+    setup_console,
+)
+
+__all__ = [
+    "VERSION",
+    "PACKAGE_FORMATS",
+    "Puller",
+    "PullService",
+    "BlobCache",
+    "ManifestCache",
+    "Telemetry",
+    "create_telemetry",
+    "create_server",
+    "setup_console",
+]
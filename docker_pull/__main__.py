@@ -0,0 +1,5 @@
+from .cli import main
+from .core import setup_console
+
+setup_console()
+main()
@@ -0,0 +1,389 @@
+# docker_pull/cli.py
+# 命令行入口：参数解析、单镜像/批量/增量同步拉取、剖析报告与常驻服务启动
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import (
+    ASYNC_CONCURRENCY, CACHE_MAX_SIZE, COMPRESSED_FORMATS, GZIP_BACKENDS, MAX_WORKERS, PACKAGE_FORMATS,
+    PROGRESS_INTERVAL, SEGMENT_SIZE, SEGMENT_WORKERS, SERVE_JOBS, TOKEN_CACHE_FILE,
+    BlobCache, LayerIndex, ManifestCache, PullService, Puller, RateLimiter,
+    _bundle_entry, _image_file_name, _unlink_socket, build_bundle, build_image, connection_report,
+    create_server, create_session, create_telemetry, download_layer_jobs, download_layer_jobs_async,
+    is_sync_current, logger, parse_image_input, parse_size, pool_size_for, profiler, read_image_list,
+    read_sync_state, resolve_image_platforms, restore_from_archive, set_gzip_backend, write_sync_state
+)
+
+def _sync_plan(args, resolved):
+    # 返回需要重新生成的镜像，以及可复用层的旧归档 [(归档路径, 状态)]
+    if args.bundle:
+        output_path = os.path.join(args.output, args.bundle)
+        state = read_sync_state(output_path)
+        if is_sync_current(state, args.format, resolved):
+            logger.info(f"合集已是最新，跳过: {output_path}")
+            return [], []
+        sources = [(output_path, state)] if state and state.get('format') == args.format else []
+        return resolved, sources
+
+    pending = []
+    sources = []
+    for image in resolved:
+        output_path = _image_output_path(args, image)
+        state = read_sync_state(output_path)
+        if is_sync_current(state, args.format, [image]):
+            logger.info(f"镜像已是最新，跳过: {image['image']}（{image['digest'][:19]}）")
+            continue
+        pending.append(image)
+        if state and state.get('format') == args.format:
+            sources.append((output_path, state))
+    return pending, sources
+
+def _image_output_path(args, image):
+    return os.path.join(args.output, _image_file_name(image))
+
+def _resolve_images(session, args, images, manifest_cache=None):
+    if len(images) == 1:
+        return resolve_image_platforms(session, args.registry, images[0], args.arch, manifest_cache)
+
+    resolved = []
+    with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        futures = [
+            executor.submit(resolve_image_platforms, session, args.registry, image, args.arch, manifest_cache)
+            for image in images
+        ]
+        for image, future in zip(images, futures):
+            try:
+                resolved.extend(future.result())
+            except Exception as e:
+                logger.error(f"镜像清单解析失败 {image}: {str(e)}")
+    return resolved
+
+def _pull_images(session, args, images, work_dir, cache, manifest_cache=None):
+    # 先解析全部清单，按摘要去重后统一下载，最后从共享层目录分别打包
+    # 不同写法指向同一镜像时（如 alpine 与 library/alpine:latest）只处理一次
+    unique = {}
+    for image in images:
+        unique.setdefault(parse_image_input(image), image)
+    images = list(unique.values())
+    with profiler.phase("resolve"):
+        resolved = _resolve_images(session, args, images, manifest_cache)
+    if manifest_cache is not None:
+        logger.info(manifest_cache.report())
+
+    sources = []
+    if args.sync:
+        resolved, sources = _sync_plan(args, resolved)
+        if not resolved:
+            logger.info("所有镜像均已是最新")
+            return
+
+    compressed = args.format in COMPRESSED_FORMATS
+    jobs = {}
+    config_jobs = {}
+    for image in resolved:
+        for layer in image['manifest']['layers']:
+            jobs.setdefault(layer['digest'], (image['repo'], image['img'], layer))
+        # 配置文件与镜像层走同一下载与缓存路径，按原样保存
+        config = image['manifest']['config']
+        config_jobs.setdefault(config['digest'], (image['repo'], image['img'], config))
+    total_layers = sum(len(image['manifest']['layers']) for image in resolved)
+    if len(resolved) > 1:
+        logger.info(f"{len(resolved)} 个镜像共 {total_layers} 个镜像层，去重后需下载 {len(jobs)} 个")
+    else:
+        logger.info(f"共需要下载 {len(jobs)} 个镜像层")
+
+    layer_index = LayerIndex(work_dir)
+    layer_index.set_order(list(jobs))
+    jobs.update(config_jobs)
+
+    for archive_path, state in sources:
+        with profiler.phase("restore"):
+            restored = restore_from_archive(archive_path, state, list(jobs), work_dir, layer_index)
+        for digest in restored:
+            del jobs[digest]
+        if restored:
+            logger.info(f"从 {os.path.basename(archive_path)} 复用 {len(restored)} 个未变化的层/配置")
+
+    download_bytes = sum(blob.get('size', 0) for _, _, blob in jobs.values())
+    start_time = time.time()
+    with profiler.phase("download", download_bytes):
+        _download_jobs(session, args, list(jobs.values()), work_dir, layer_index, cache, compressed)
+    elapsed = time.time() - start_time
+    logger.info(
+        f"镜像层下载完成（{args.engine} 引擎，耗时 {elapsed:.2f} 秒，"
+        f"{download_bytes / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s）"
+    )
+    logger.info(connection_report(session))
+    if cache is not None:
+        logger.info(cache.report())
+
+    with profiler.phase("build"):
+        _build_outputs(args, resolved, work_dir, layer_index, compressed)
+
+def _download_jobs(session, args, jobs, work_dir, layer_index, cache, compressed):
+    if args.engine == "async":
+        download_layer_jobs_async(
+            args.registry,
+            jobs,
+            work_dir,
+            layer_index=layer_index,
+            concurrency=args.async_concurrency,
+            segment_size=args.segment_size,
+            cache=cache,
+            decompress=not compressed,
+            token_manager=session.token_manager,
+            rate_limiter=session.rate_limiter,
+            schedule=args.schedule,
+            decompress_workers=args.decompress_workers,
+            telemetry=session.telemetry,
+            verify=session.verify
+        )
+    else:
+        download_layer_jobs(
+            session,
+            args.registry,
+            jobs,
+            work_dir,
+            layer_index=layer_index,
+            workers=args.workers,
+            segment_size=args.segment_size,
+            segment_workers=args.segment_workers,
+            cache=cache,
+            decompress=not compressed,
+            schedule=args.schedule,
+            decompress_workers=args.decompress_workers
+        )
+
+def _build_outputs(args, resolved, work_dir, layer_index, compressed):
+    if args.bundle:
+        output_path = os.path.join(args.output, args.bundle)
+        build_bundle(output_path, work_dir, [_bundle_entry(image, compressed) for image in resolved], args.format)
+        write_sync_state(output_path, args.format, resolved, layer_index)
+        return
+
+    built = 0
+    for image in resolved:
+        repo, img, tag = image['repo'], image['img'], image['tag']
+        output_path = _image_output_path(args, image)
+        try:
+            build_image(
+                output_path, work_dir, repo, img, tag, args.format,
+                layer_digests=[layer['digest'] for layer in image['manifest']['layers']],
+                manifest_raw=image['manifest_raw'],
+                config_digest=image['manifest']['config']['digest']
+            )
+            write_sync_state(output_path, args.format, [image], layer_index)
+            built += 1
+        except Exception as e:
+            if len(resolved) == 1:
+                raise
+            logger.error(f"镜像打包失败 {image['image']}: {str(e)}")
+    if len(resolved) > 1:
+        logger.info(f"批量拉取完成: 成功 {built}/{len(resolved)} 个镜像")
+
+def serve(args):
+    jobs = max(args.serve_jobs, 1)
+    progress = "log" if args.progress == "auto" else args.progress
+    telemetry = create_telemetry(progress, args.progress_file, args.metrics_file, args.progress_interval)
+    cache_dir = args.cache_dir
+    manifest_cache_dir = args.manifest_cache or (os.path.join(cache_dir, "manifests") if cache_dir else None)
+    work_dir = os.path.join(args.output, "layers")
+    puller = Puller(
+        args.registry, work_dir,
+        workers=args.workers,
+        segment_size=args.segment_size,
+        segment_workers=args.segment_workers,
+        cache_dir=cache_dir,
+        cache_size=args.cache_size,
+        manifest_cache_dir=manifest_cache_dir,
+        token_cache=None if args.no_token_cache else args.token_cache,
+        transport=args.transport,
+        limit_rate=args.limit_rate,
+        verify=not args.insecure,
+        schedule=args.schedule,
+        decompress_workers=args.decompress_workers,
+        telemetry=telemetry,
+        pool_size=pool_size_for(args.workers * jobs, args.segment_workers)
+    )
+    set_gzip_backend(args.decompressor)
+    service = PullService(puller, args.output, work_dir, jobs)
+    try:
+        server = create_server(args.serve, service)
+    except (OSError, ValueError) as e:
+        logger.error(f"无法启动拉取服务 {args.serve}: {str(e)}")
+        service.close()
+        telemetry.close()
+        puller.close()
+        sys.exit(1)
+    # systemd 等发送 SIGTERM 时与 Ctrl+C 一样正常退出
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    logger.info(f"拉取服务已启动: {args.serve}（同时执行 {jobs} 个任务，输出目录 {service.output_dir}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("正在停止拉取服务")
+    finally:
+        server.server_close()
+        if args.serve.startswith("unix:"):
+            _unlink_socket(args.serve[len("unix:"):])
+        service.close()
+        telemetry.close()
+        puller.close()
+        # 失败任务留下的未完成下载保留供重启后续传，否则删除共享工作目录
+        partial = [name for _, _, files in os.walk(work_dir) for name in files if ".download" in name]
+        if partial:
+            logger.info(f"已保留 {len(partial)} 个未完成的下载: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def main():
+    parser = argparse.ArgumentParser(description="Docker镜像下载工具")
+    parser.add_argument("image", nargs="?", help="镜像名称 (例如: ubuntu:latest 或 library/alpine:3.12)")
+    parser.add_argument("-b", "--batch", metavar="FILE",
+                       help="批量模式：从文件读取镜像列表（每行一个，- 表示标准输入），共享的镜像层只下载一次")
+    parser.add_argument("--bundle", metavar="NAME",
+                       help="将所有镜像写入输出目录下的同一个归档文件（如 images.tar），相同的层只保存一份")
+    parser.add_argument("--sync", action="store_true",
+                       help="增量同步：清单摘要与上次生成的归档一致时跳过，否则只下载变化的层")
+    parser.add_argument("-a", "--arch", default="amd64",
+                       help="目标架构，可用逗号分隔多个（如 amd64,arm64/v8）或 all 表示全部平台 (默认: amd64)")
+    parser.add_argument("-r", "--registry", default="registry-1.docker.io", help="镜像仓库地址")
+    parser.add_argument("-o", "--output", default="output", help="输出目录")
+    parser.add_argument("-j", "--workers", type=int, default=MAX_WORKERS, 
+                       help=f"并发下载数 (默认: {MAX_WORKERS})")
+    parser.add_argument("-f", "--format", 
+                       choices=PACKAGE_FORMATS,
+                       default="synology",
+                       help="打包格式 (默认: %(default)s)")
+    parser.add_argument("--segment-size", type=parse_size, default=SEGMENT_SIZE,
+                       help="大文件分段下载的分段大小，支持K/M/G后缀 (默认: 16M)")
+    parser.add_argument("--segment-workers", type=int, default=SEGMENT_WORKERS,
+                       help=f"单个镜像层的并发分段数，1表示不分段 (默认: {SEGMENT_WORKERS})")
+    parser.add_argument("--limit-rate", type=parse_size, default=0, metavar="RATE",
+                       help="全部下载共享的总带宽上限（字节/秒），支持K/M/G后缀，0表示不限速 (默认: 0)")
+    parser.add_argument("--schedule", choices=["largest", "smallest", "manifest"], default="largest",
+                       help="镜像层下载顺序：largest 最大优先 / smallest 最短剩余优先 / manifest 清单顺序 (默认: %(default)s)")
+    parser.add_argument("--decompress-workers", type=int, default=None, metavar="N",
+                       help="解压线程数，与下载并行；0 表示在下载线程内直接解压 (默认: CPU 核数)")
+    parser.add_argument("--decompressor", choices=["auto"] + GZIP_BACKENDS, default="auto",
+                       help="gzip 解压后端，auto 按 isal、zlib-ng、pigz、zlib 顺序选择已安装的实现 (默认: %(default)s)")
+    parser.add_argument("--progress", choices=["auto", "bar", "log", "jsonl", "none"], default="auto",
+                       help="进度输出：bar 汇总进度条 / log 定时日志行 / jsonl JSON Lines 事件流 / none 不输出；"
+                            "auto 在终端中用 bar，否则用 log (默认: %(default)s)")
+    parser.add_argument("--progress-file", metavar="FILE",
+                       help="jsonl 事件流写入的文件 (默认: 标准输出)")
+    parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL, metavar="SECONDS",
+                       help="进度与指标的刷新间隔（秒） (默认: %(default)s)")
+    parser.add_argument("--metrics-file", metavar="FILE",
+                       help="以 Prometheus 文本格式写入下载指标（可供 node_exporter textfile 采集）")
+    parser.add_argument("--profile", action="store_true",
+                       help="结束时输出各阶段（认证、清单、下载、校验、解压、打包）的耗时、字节数、吞吐与峰值内存")
+    parser.add_argument("--profile-json", metavar="FILE",
+                       help="剖析结果的 JSON 文件 (默认: 输出目录下的 profile.json)")
+    parser.add_argument("--profile-cprofile", metavar="FILE",
+                       help="同时用 cProfile 记录函数级耗时并保存为 pstats 文件（隐含 --profile）")
+    parser.add_argument("--profile-memory", action="store_true",
+                       help="同时用 tracemalloc 统计各阶段 Python 对象的峰值内存（隐含 --profile，有额外开销）")
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread",
+                       help="下载引擎：thread 线程池 / async 协程（需安装 aiohttp） (默认: %(default)s)")
+    parser.add_argument("--transport", choices=["http1", "http2"], default="http1",
+                       help="线程池引擎的HTTP传输：http2 在每个主机的一条连接上多路复用（需安装 httpx[http2]） (默认: %(default)s)")
+    parser.add_argument("--async-concurrency", type=int, default=ASYNC_CONCURRENCY,
+                       help=f"异步引擎对每个仓库主机的最大并发请求数 (默认: {ASYNC_CONCURRENCY})")
+    parser.add_argument("--cache-dir", help="启用本地镜像层缓存并指定缓存目录，多次拉取间共享相同的层")
+    parser.add_argument("--cache-size", type=parse_size, default=CACHE_MAX_SIZE,
+                       help="缓存容量上限，超出后按最近最少使用淘汰，支持K/M/G后缀 (默认: 20G)")
+    parser.add_argument("--manifest-cache", metavar="DIR",
+                       help="清单缓存目录，标签以条件请求重新验证，未变化时不再下载清单 (默认: 缓存目录下的 manifests)")
+    parser.add_argument("--token-cache", default=TOKEN_CACHE_FILE,
+                       help="令牌缓存文件，保存未过期的认证令牌供下次运行复用 (默认: %(default)s)")
+    parser.add_argument("--no-token-cache", action="store_true", help="不在磁盘上保存认证令牌")
+    parser.add_argument("--insecure", action="store_true", help="跳过SSL证书验证")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                       help="以常驻服务运行，通过本地 HTTP（如 127.0.0.1:8765）或 unix 套接字（unix:/path/to/sock）"
+                            "接收拉取任务，连接、令牌与缓存在任务之间保持")
+    parser.add_argument("--serve-jobs", type=int, default=SERVE_JOBS, metavar="N",
+                       help=f"服务模式下同时执行的任务数 (默认: {SERVE_JOBS})")
+    parser.add_argument("--debug", action="store_true", help="启用调试日志")
+    
+    args = parser.parse_args()
+    if not args.image and not args.batch and not args.serve:
+        parser.error("需要指定镜像名称或 --batch 镜像列表文件")
+    if args.segment_size <= 0:
+        parser.error("--segment-size 必须大于 0")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    if args.serve:
+        if args.engine == "async":
+            logger.warning("服务模式使用线程池引擎，忽略 --engine async")
+        serve(args)
+        return
+    if args.profile or args.profile_cprofile or args.profile_memory:
+        profiler.enable(cprofile=bool(args.profile_cprofile), memory=args.profile_memory)
+    
+    completed = False
+    try:
+        work_dir = os.path.join(args.output, "layers")
+        os.makedirs(work_dir, exist_ok=True)
+        
+        session = create_session(
+            None if args.no_token_cache else args.token_cache,
+            pool_size_for(args.workers, args.segment_workers),
+            args.transport
+        )
+        session.verify = not args.insecure
+        session.rate_limiter = RateLimiter(args.limit_rate) if args.limit_rate else None
+        session.telemetry = create_telemetry(
+            args.progress, args.progress_file, args.metrics_file, args.progress_interval
+        )
+        if args.format not in COMPRESSED_FORMATS:
+            set_gzip_backend(args.decompressor)
+        
+        images = read_image_list(args.batch) if args.batch else []
+        if args.image:
+            images.insert(0, args.image)
+        cache = BlobCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+        manifest_cache_dir = args.manifest_cache or (
+            os.path.join(args.cache_dir, "manifests") if args.cache_dir else None
+        )
+        manifest_cache = ManifestCache(manifest_cache_dir) if manifest_cache_dir else None
+        _pull_images(session, args, images, work_dir, cache, manifest_cache)
+        completed = True
+        
+    except KeyboardInterrupt:
+        logger.info("用户中止操作")
+    except Exception as e:
+        logger.error(f"程序运行错误: {str(e)}")
+    finally:
+        if getattr(session, 'telemetry', None) is not None:
+            session.telemetry.close()
+        session.close()
+        if profiler.enabled:
+            _write_profile(args)
+        # 失败或中断时保留工作目录，重新运行同一命令即可续传
+        if completed and os.path.exists(work_dir):
+            shutil.rmtree(work_dir, ignore_errors=True)
+        elif os.path.exists(work_dir):
+            logger.info(f"已保留未完成的下载: {work_dir}，重新运行同一命令即可续传")
+
+def _write_profile(args):
+    report = profiler.report()
+    logger.info(f"各阶段耗时:\n{profiler.table(report)}")
+    json_path = args.profile_json or os.path.join(args.output, "profile.json")
+    os.makedirs(os.path.dirname(os.path.abspath(json_path)), exist_ok=True)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    logger.info(f"剖析结果已保存: {json_path}")
+    if args.profile_cprofile:
+        stats = profiler.dump_cprofile(args.profile_cprofile)
+        if stats is not None:
+            logger.info(f"cProfile 结果已保存: {args.profile_cprofile}（可用 python -m pstats 查看）")
@@ -0,0 +1,3492 @@
+# docker_pull/core.py
+# 镜像拉取的实现：认证、清单解析、镜像层下载与解压、打包与常驻服务；命令行参数处理见 cli.py
+import os
+import sys
+import time
+import zlib
+import json
+import hashlib
+import shutil
+import threading
+import logging
+import importlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from urllib.parse import parse_qs, urlsplit
+
+# 全局配置
+VERSION = "v16.0.0"
+CHUNK_SIZE = 1024 * 512
+MAX_RETRIES = 3
+RETRY_DELAY = 5
+MAX_WORKERS = 1
+RETRY_BACKOFF = 2
+GZIP_WBITS = zlib.MAX_WBITS | 16
+GZIP_BACKENDS = ["isal", "zlib-ng", "pigz", "zlib"]
+LAYER_INDEX_FILE = "layers.json"
+SEGMENT_SIZE = 1024 * 1024 * 16
+SEGMENT_WORKERS = 4
+ASYNC_CONCURRENCY = 64
+CACHE_MAX_SIZE = 1024 ** 3 * 20
+TOKEN_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".docker_pull", "tokens.json")
+TOKEN_EXPIRY_MARGIN = 30
+SYNC_STATE_SUFFIX = ".sync.json"
+POOL_MAXSIZE = 10
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 10
+POOL_HOSTS = 16
+RETRY_STATUS = [429, 500, 502, 503, 504]
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'}
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json"
+]
+COMPRESSED_FORMATS = ("oci", "docker-gz")
+PACKAGE_FORMATS = ["docker", "synology", "oci", "docker-gz"]
+SERVE_JOBS = 4
+SERVE_MAX_WAIT = 3600
+JOB_HISTORY = 1000
+JOB_STATES = ("queued", "resolving", "downloading", "building", "done", "failed")
+
+# 作为库导入时不输出日志，由调用方配置；命令行入口调用 setup_console
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def setup_console():
+    # 解决 Windows 终端编码问题
+    sys.stdout.reconfigure(encoding='utf-8')
+    sys.stderr.reconfigure(encoding='utf-8')
+    # 初始化日志系统
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        handlers=[
+            logging.FileHandler("docker_pull.log", encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+    # httpx 默认为每个请求输出 INFO 日志
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# 可选依赖（aiohttp、httpx、isal、zlib-ng、zstandard）在首次使用时才导入，未安装时返回 None
+_optional_modules = {}
+
+def optional_module(name):
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
+# requests、asyncio 等导入较慢或只在部分功能中用到的模块，首次访问其属性时才导入
+#（作为库导入时，未用到这些功能的调用方无需付出这部分开销）
+class _LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+requests = _LazyModule("requests")
+asyncio = _LazyModule("asyncio")
+# tarfile 只在打包与从旧归档恢复时使用，subprocess 只在 pigz 解压时使用
+tarfile = _LazyModule("tarfile")
+subprocess = _LazyModule("subprocess")
+
+# 适配器类继承自 requests 的 HTTPAdapter，首次创建会话时才导入 requests 并定义，返回 (TimeoutHTTPAdapter, Http2Adapter)
+_http_adapter_classes = None
+
+def http_adapters():
+    global _http_adapter_classes
+    if _http_adapter_classes is None:
+        from requests.adapters import HTTPAdapter
+        from requests.structures import CaseInsensitiveDict
+        from requests.utils import get_encoding_from_headers
+
+        class TimeoutHTTPAdapter(HTTPAdapter):
+            def __init__(self, timeout=30, *args, **kwargs):
+                self.timeout = timeout
+                super().__init__(*args, **kwargs)
+
+            def send(self, request, **kwargs):
+                kwargs["timeout"] = kwargs.get("timeout") or self.timeout
+                return super().send(request, **kwargs)
+
+        # HTTP/2 传输：同一主机的清单、令牌与 blob 请求在一条连接上多路复用（依赖可选的 httpx[http2]），
+        # 未协商出 h2 的主机改回 HTTP/1.1 连接池；代理沿用 HTTP_PROXY/HTTPS_PROXY 环境变量
+        class Http2Adapter(TimeoutHTTPAdapter):
+            def __init__(self, timeout=30, *args, **kwargs):
+                if optional_module("httpx") is None:
+                    raise RuntimeError("HTTP/2 传输需要安装 httpx: pip install 'httpx[http2]'")
+                super().__init__(timeout, *args, **kwargs)
+                self.clients = {}
+                self.lock = threading.Lock()
+                self.http1_hosts = set()
+                self.stats = {}
+
+            def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+                host = urlsplit(request.url).netloc
+                if not request.url.startswith('https://') or host in self.http1_hosts:
+                    return super().send(request, stream=stream, timeout=timeout, verify=verify,
+                                        cert=cert, proxies=proxies)
+
+                httpx = optional_module("httpx")
+                client = self._client(verify)
+                headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+                for attempt in range(MAX_RETRIES + 1):
+                    try:
+                        h2_resp = client.send(client.build_request(
+                            request.method, request.url, headers=headers, content=request.body,
+                            timeout=timeout or self.timeout
+                        ), stream=True)
+                    except httpx.TimeoutException as e:
+                        raise requests.exceptions.Timeout(e, request=request)
+                    except httpx.TransportError as e:
+                        raise requests.exceptions.ConnectionError(e, request=request)
+                    if h2_resp.status_code not in RETRY_STATUS or attempt >= MAX_RETRIES:
+                        break
+                    h2_resp.close()
+                    time.sleep(1.5 * (2 ** attempt))
+
+                self._record(host, h2_resp.http_version)
+                resp = requests.Response()
+                resp.status_code = h2_resp.status_code
+                resp.headers = CaseInsensitiveDict(h2_resp.headers.items())
+                resp.encoding = get_encoding_from_headers(resp.headers)
+                resp.reason = h2_resp.reason_phrase
+                resp.raw = _Http2Body(h2_resp)
+                resp.url = request.url
+                resp.request = request
+                resp.connection = self
+                return resp
+
+            def close(self):
+                with self.lock:
+                    for client in self.clients.values():
+                        client.close()
+                    self.clients.clear()
+                super().close()
+
+            def _client(self, verify):
+                httpx = optional_module("httpx")
+                with self.lock:
+                    if verify not in self.clients:
+                        try:
+                            self.clients[verify] = httpx.Client(
+                                http2=True,
+                                verify=verify,
+                                follow_redirects=False,
+                                limits=httpx.Limits(
+                                    max_connections=self._pool_maxsize,
+                                    max_keepalive_connections=self._pool_maxsize
+                                )
+                            )
+                        except ImportError:
+                            raise RuntimeError("HTTP/2 传输需要安装 h2: pip install 'httpx[http2]'")
+                    return self.clients[verify]
+
+            def _record(self, host, http_version):
+                with self.lock:
+                    stat = self.stats.setdefault(host, {'requests': 0, 'http2': 0})
+                    stat['requests'] += 1
+                    if http_version == "HTTP/2":
+                        stat['http2'] += 1
+                    elif host not in self.http1_hosts:
+                        self.http1_hosts.add(host)
+                        logger.info(f"{host} 未协商出 HTTP/2（{http_version}），改用 HTTP/1.1 连接池")
+
+        _http_adapter_classes = (TimeoutHTTPAdapter, Http2Adapter)
+    return _http_adapter_classes
+
+# 把 httpx 的流式响应包装成 requests 可读取的 raw 对象
+class _Http2Body:
+    def __init__(self, response):
+        self.response = response
+
+    def stream(self, chunk_size=None, decode_content=True):
+        httpx = optional_module("httpx")
+        try:
+            yield from self.response.iter_bytes(chunk_size)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ConnectionError(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+    def read(self, amt=None, decode_content=True):
+        return b''.join(self.stream(amt))
+
+    def close(self):
+        self.response.close()
+
+def create_session(token_cache=None, pool_size=POOL_MAXSIZE, transport="http1"):
+    from urllib3.util.retry import Retry
+    TimeoutHTTPAdapter, Http2Adapter = http_adapters()
+    retry_strategy = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=1.5,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=["HEAD", "GET"]
+    )
+    
+    # 每个主机（仓库、认证服务、blob 重定向的 CDN）各有独立连接池，
+    # 池大小与并发请求数一致，避免连接被丢弃后重新握手
+    adapter = TimeoutHTTPAdapter(
+        max_retries=retry_strategy,
+        timeout=30,
+        pool_connections=POOL_HOSTS,
+        pool_maxsize=pool_size
+    )
+    
+    # 证书校验由 session.verify 控制；设置了 REQUESTS_CA_BUNDLE 等环境变量时 requests 会忽略会话上的设置，
+    # 因此各请求显式传入 verify=session.verify
+    session = requests.Session()
+    session.mount("http://", adapter)
+    if transport == "http2":
+        session.mount("https://", Http2Adapter(
+            max_retries=retry_strategy,
+            timeout=30,
+            pool_connections=POOL_HOSTS,
+            pool_maxsize=pool_size
+        ))
+    else:
+        session.mount("https://", adapter)
+    
+    session.proxies.update({
+        'http': os.environ.get('HTTP_PROXY'),
+        'https': os.environ.get('HTTPS_PROXY')
+    })
+    session.token_manager = TokenManager(token_cache)
+    session.rate_limiter = None
+    session.telemetry = None
+    
+    return session
+
+def pool_size_for(workers, segment_workers):
+    return max(workers * max(segment_workers, 1), POOL_MAXSIZE)
+
+def connection_report(session):
+    # urllib3 连接池按主机统计请求数与新建连接数，二者之差即复用的连接次数
+    lines = []
+    for adapter in {id(a): a for a in session.adapters.values()}.values():
+        # 经代理的请求使用 proxy_manager 中按代理地址区分的连接池
+        managers = [adapter.poolmanager] + list(getattr(adapter, 'proxy_manager', {}).values())
+        for manager in managers:
+            pools = manager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None or not pool.num_requests:
+                    continue
+                reused = pool.num_requests - pool.num_connections
+                proxy = getattr(manager, 'proxy', None)
+                via = f"（经代理 {proxy.host}）" if proxy is not None and proxy.host != pool.host else ""
+                lines.append(
+                    f"  {pool.host}{via}: 请求 {pool.num_requests} 次，新建连接 {pool.num_connections} 个，"
+                    f"复用 {reused} 次（{reused / pool.num_requests * 100:.1f}%）"
+                )
+        for host, stat in getattr(adapter, 'stats', {}).items():
+            if stat['http2']:
+                lines.append(f"  {host}: HTTP/2 多路复用请求 {stat['http2']}/{stat['requests']} 次")
+    return "连接复用统计:\n" + "\n".join(lines) if lines else "连接复用统计: 无请求"
+
+def parse_image_input(image_input):
+    if '/' not in image_input:
+        repo = 'library'
+        image_part = image_input
+    else:
+        repo, image_part = image_input.rsplit('/', 1)
+    
+    tag = 'latest' if ':' not in image_part else image_part.split(':', 1)[1]
+    img = image_part.split(':', 1)[0]
+    
+    return repo, img, tag
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+# 令牌管理：按仓库记住认证质询（realm/service），同一作用域的并发刷新只请求一次，
+# 未过期的令牌可保存到磁盘供下次运行复用
+class TokenManager:
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.scope_locks = {}
+        self.challenges = {}
+        self.tokens = {}
+        if cache_path:
+            self._load()
+
+    def headers(self, session, registry, repo, img, force_refresh=False):
+        key = f"{registry}|repository:{repo}/{img}:pull"
+        with self.lock:
+            cached = self.tokens.get(key)
+            scope_lock = self.scope_locks.setdefault(key, threading.Lock())
+        if not force_refresh and self._valid(cached):
+            logger.debug(f"重用缓存令牌前8位: {cached['token'][:8]}******")
+            return {'Authorization': f"Bearer {cached['token']}"}
+
+        with scope_lock:
+            # 等待期间其他线程可能已完成刷新，直接使用其结果
+            with self.lock:
+                current = self.tokens.get(key)
+            if self._valid(current) and (not force_refresh or current is not cached):
+                return {'Authorization': f"Bearer {current['token']}"}
+
+            with profiler.span("auth"):
+                challenge = self._challenge(session, registry, force_refresh)
+                if not challenge:
+                    return {}
+                try:
+                    entry = self._request_token(session, challenge, repo, img)
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    if force_refresh:
+                        raise
+                    # 缓存的认证质询可能已失效（如 realm 地址变更），重新探测后再试一次
+                    logger.debug(f"使用缓存的认证质询获取令牌失败（{str(e)}），重新探测 {registry}")
+                    challenge = self._challenge(session, registry, True)
+                    if not challenge:
+                        return {}
+                    entry = self._request_token(session, challenge, repo, img)
+            with self.lock:
+                self.tokens[key] = entry
+                self._save()
+            return {'Authorization': f"Bearer {entry['token']}"}
+
+    def cached(self, registry, repo, img):
+        with self.lock:
+            entry = self.tokens.get(f"{registry}|repository:{repo}/{img}:pull")
+        return entry if self._valid(entry) else None
+
+    def store(self, registry, repo, img, token, expires_in):
+        with self.lock:
+            self.tokens[f"{registry}|repository:{repo}/{img}:pull"] = {
+                'token': token,
+                'expires': time.time() + expires_in
+            }
+            self._save()
+
+    def challenge(self, registry):
+        with self.lock:
+            return self.challenges.get(registry)
+
+    def set_challenge(self, registry, challenge):
+        with self.lock:
+            self.challenges[registry] = challenge
+            self._save()
+
+    def _challenge(self, session, registry, force_refresh):
+        challenge = self.challenge(registry)
+        # 收到 401 后总是重新探测并覆盖记录：保存的 realm/service 可能已失效，记录为无需认证的仓库也可能已开启认证
+        if challenge is not None and not force_refresh:
+            return challenge
+
+        resp = session.get(f"https://{registry}/v2/", verify=session.verify)
+        challenge = {}
+        if resp.status_code == 401:
+            challenge = parse_auth_challenge(resp.headers.get('Www-Authenticate', ''))
+        self.set_challenge(registry, challenge)
+        return challenge
+
+    def _request_token(self, session, challenge, repo, img):
+        token_url = f"{challenge['realm']}?service={challenge['service']}&scope=repository:{repo}/{img}:pull"
+        resp = session.get(token_url, verify=session.verify)
+        resp.raise_for_status()
+
+        token_data = resp.json()
+        token = token_data["token"]
+        expires_in = token_data.get('expires_in', 3600)
+        logger.debug(f"获取新令牌前8位: {token[:8]}******")
+        logger.debug(f"获取新令牌（有效期{expires_in}秒）")
+        return {'token': token, 'expires': time.time() + expires_in}
+
+    @staticmethod
+    def _valid(entry):
+        return bool(entry) and entry['expires'] > time.time() + TOKEN_EXPIRY_MARGIN
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.warning("令牌缓存文件损坏，已忽略")
+            return
+        self.challenges.update(data.get('challenges', {}))
+        self.tokens.update({
+            key: entry for key, entry in data.get('tokens', {}).items() if self._valid(entry)
+        })
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        # 合并其他进程写入的令牌后原子替换，文件仅当前用户可读
+        tokens = dict(self.tokens)
+        challenges = dict(self.challenges)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                for key, entry in data.get('tokens', {}).items():
+                    if key not in tokens and self._valid(entry):
+                        tokens[key] = entry
+                for registry, challenge in data.get('challenges', {}).items():
+                    challenges.setdefault(registry, challenge)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'challenges': challenges,
+                    'tokens': {key: entry for key, entry in tokens.items() if self._valid(entry)}
+                }, f)
+            os.replace(tmp_path, self.cache_path)
+        except (OSError, ValueError) as e:
+            logger.debug(f"令牌缓存写入失败: {str(e)}")
+
+def parse_auth_challenge(auth_header):
+    service = auth_header.split('service="')[1].split('"')[0]
+    realm = auth_header.split('realm="')[1].split('"')[0]
+    return {'realm': realm, 'service': service}
+
+_token_manager_lock = threading.Lock()
+
+def get_auth_token(session, registry, repo, img, force_refresh=False):
+    with _token_manager_lock:
+        if not hasattr(session, 'token_manager'):
+            session.token_manager = TokenManager()
+    try:
+        return session.token_manager.headers(session, registry, repo, img, force_refresh)
+    except Exception as e:
+        logger.error(f"认证失败: {str(e)}")
+        raise
+
+def fetch_manifest(session, registry, repo, img, reference, auth_headers, manifest_cache=None):
+    # 返回解析后的清单以及原始字节，原始字节用于按摘要原样写入 OCI 布局
+    ref_key = f"{registry}/{repo}/{img}@{reference}"
+    entry = None
+    if manifest_cache is not None:
+        # 按摘要引用的清单内容不可变，命中后无需任何请求
+        if reference.startswith('sha256:'):
+            cached = manifest_cache.get(reference)
+            if cached:
+                return cached
+        entry = manifest_cache.lookup(ref_key)
+
+    url = f"https://{registry}/v2/{repo}/{img}/manifests/{reference}"
+    headers = dict(auth_headers or {})
+    headers['Accept'] = ', '.join(MANIFEST_MEDIA_TYPES)
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    with profiler.span("manifest") as span:
+        resp = session.get(url, headers=headers, verify=session.verify)
+        if resp.status_code == 401:
+            # 令牌被拒绝（如缓存的令牌或认证质询已失效）时刷新后重试一次
+            _telemetry(session).auth_refresh()
+            headers.update(get_auth_token(session, registry, repo, img, force_refresh=True))
+            resp = session.get(url, headers=headers, verify=session.verify)
+        if resp.status_code == 304 and entry:
+            cached = manifest_cache.revalidated(entry)
+            if cached:
+                return cached
+            headers.pop('If-None-Match')
+            resp = session.get(url, headers=headers, verify=session.verify)
+        resp.raise_for_status()
+        raw = resp.content
+        span.bytes = len(raw)
+    manifest = json.loads(raw)
+    media_type = manifest.get('mediaType') or resp.headers.get('Content-Type', '').split(';')[0]
+    if manifest_cache is not None:
+        manifest_cache.store(ref_key, raw, media_type, resp.headers.get('ETag'))
+    return manifest, raw, media_type
+
+def get_manifest(session, registry, repo, img, tag, auth_headers):
+    return fetch_manifest(session, registry, repo, img, tag, auth_headers)[0]
+
+def parse_platforms(value):
+    # "amd64,arm64/v8,linux/arm/v7" → 平台列表；"all" 返回 None 表示全部 linux 平台
+    if value.strip().lower() == 'all':
+        return None
+    platforms = []
+    for item in value.split(','):
+        parts = [part for part in item.strip().split('/') if part]
+        if not parts:
+            continue
+        if parts[0] == 'linux':
+            parts = parts[1:]
+        if not parts:
+            raise ValueError(f"无效的架构参数: {value}")
+        platforms.append({
+            'os': 'linux',
+            'architecture': parts[0],
+            'variant': parts[1] if len(parts) > 1 else None
+        })
+    if not platforms:
+        raise ValueError(f"无效的架构参数: {value}")
+    return platforms
+
+def platform_name(platform):
+    variant = platform.get('variant')
+    return f"{platform['architecture']}-{variant}" if variant else platform['architecture']
+
+def _platform_matches(platform, target):
+    if platform.get('os') != target['os'] or platform.get('architecture') != target['architecture']:
+        return False
+    if not target['variant']:
+        return True
+    # arm64 省略 variant 时即为 v8
+    variant = platform.get('variant') or ('v8' if platform.get('architecture') == 'arm64' else None)
+    return variant == target['variant']
+
+def _select_platforms(manifest_data, targets):
+    if targets is None:
+        # 跳过 unknown/unknown 的构建证明（attestation）清单
+        return [
+            m for m in manifest_data['manifests']
+            if m.get('platform', {}).get('os') == 'linux'
+            and m.get('platform', {}).get('architecture') not in (None, 'unknown')
+        ]
+    selected = []
+    for target in targets:
+        for m in manifest_data['manifests']:
+            if _platform_matches(m.get('platform', {}), target):
+                if m not in selected:
+                    selected.append(m)
+                break
+        else:
+            raise ValueError(f"未找到 {platform_name(target).replace('-', '/')} 架构的镜像")
+    return selected
+
+def _select_platform(manifest_data, target_arch):
+    return _select_platforms(manifest_data, parse_platforms(target_arch))[0]
+
+def select_architecture(manifest_data, target_arch, session, registry, repo, img, auth_headers):
+    if 'manifests' not in manifest_data:
+        return manifest_data
+    
+    m = _select_platform(manifest_data, target_arch)
+    return get_manifest(
+        session, 
+        registry, 
+        repo, 
+        img, 
+        m['digest'], 
+        auth_headers
+    )
+
+# 解压后端：gzip 层优先使用已安装的 isal / zlib-ng 绑定或 pigz 子进程，否则使用标准库 zlib；
+# zstd 层使用可选的 zstandard，未压缩的层原样写出
+_gzip_backend = None
+
+def _pigz_path():
+    return shutil.which("pigz") or shutil.which("unpigz")
+
+def gzip_backend_available(name):
+    return {
+        "isal": optional_module("isal.isal_zlib") is not None,
+        "zlib-ng": optional_module("zlib_ng.zlib_ng") is not None,
+        "pigz": _pigz_path() is not None,
+        "zlib": True
+    }[name]
+
+def set_gzip_backend(name="auto"):
+    global _gzip_backend
+    if name == "auto":
+        name = next(backend for backend in GZIP_BACKENDS if gzip_backend_available(backend))
+    elif not gzip_backend_available(name):
+        raise RuntimeError(f"解压后端 {name} 不可用，请安装 isal / zlib-ng Python 包或 pigz")
+    _gzip_backend = name
+    logger.info(f"gzip 解压后端: {name}")
+    return name
+
+def gzip_backend():
+    if _gzip_backend is None:
+        return set_gzip_backend()
+    return _gzip_backend
+
+def layer_compression(descriptor):
+    media_type = descriptor.get('mediaType', '')
+    if 'zstd' in media_type:
+        return 'zstd'
+    if media_type.endswith('.tar') or media_type.endswith('.tar.uncompressed'):
+        return 'none'
+    return 'gzip'
+
+def new_decompressor(compression="gzip"):
+    if compression == "zstd":
+        zstandard = optional_module("zstandard")
+        if zstandard is None:
+            raise RuntimeError("zstd 压缩的镜像层需要安装 zstandard: pip install zstandard")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if compression == "none":
+        return _IdentityDecompressor()
+    backend = gzip_backend()
+    if backend == "isal":
+        return optional_module("isal.isal_zlib").decompressobj(GZIP_WBITS)
+    if backend == "zlib-ng":
+        return optional_module("zlib_ng.zlib_ng").decompressobj(GZIP_WBITS)
+    if backend == "pigz":
+        return _PigzDecompressor()
+    return zlib.decompressobj(GZIP_WBITS)
+
+def decompress_errors():
+    # 只包含已导入的解压实现的异常类型
+    errors = [zlib.error]
+    for name, attr in (("isal.isal_zlib", "error"), ("zlib_ng.zlib_ng", "error"), ("zstandard", "ZstdError")):
+        module = _optional_modules.get(name)
+        if module is not None:
+            errors.append(getattr(module, attr))
+    return tuple(errors)
+
+class _IdentityDecompressor:
+    eof = True
+    unused_data = b''
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+# pigz 子进程解压：数据写入 stdin，由读取线程收集 stdout，接口与 zlib 解压对象一致
+class _PigzDecompressor:
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [_pigz_path(), "-dc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        self.output = deque()
+        self.eof = False
+        self.unused_data = b''
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        for chunk in iter(lambda: self.proc.stdout.read1(CHUNK_SIZE), b''):
+            self.output.append(chunk)
+
+    def _collect(self):
+        data = []
+        while self.output:
+            data.append(self.output.popleft())
+        return b''.join(data)
+
+    def decompress(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            self.close()
+            raise zlib.error("pigz 解压失败: 进程已退出")
+        return self._collect()
+
+    def flush(self):
+        self.proc.stdin.close()
+        self.reader.join()
+        error = self.proc.stderr.read().decode(errors='replace').strip()
+        if self.proc.wait() != 0:
+            raise zlib.error(f"pigz 解压失败: {error}")
+        self.eof = True
+        return self._collect()
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        for f in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                f.close()
+            except OSError:
+                pass
+
+# 解压流水线：下载线程只负责写盘与摘要校验，gzip 解压与 diff_id 计算交给按 CPU 数设定的线程池，
+# 不同镜像层的下载与解压完全重叠（zlib 与 hashlib 处理大块数据时释放 GIL）
+class DecompressPipeline:
+    def __init__(self, workers=None, max_pending=8):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gunzip")
+        self.lock = threading.Lock()
+        self.bytes_in = 0
+        self.busy = 0.0
+        self.started = time.time()
+        self.closed = False
+
+    def lane(self, func):
+        return _PipelineLane(self, func)
+
+    def record(self, size, elapsed):
+        with self.lock:
+            self.bytes_in += size
+            self.busy += elapsed
+
+    def shutdown(self):
+        self.closed = True
+        self.executor.shutdown(wait=True)
+
+    def report(self):
+        rate = self.bytes_in / 1024 / 1024 / self.busy if self.busy else 0.0
+        return (
+            f"解压阶段（{gzip_backend()}）: {self.workers} 个线程处理 {self.bytes_in / 1024 / 1024:.1f} MB 压缩数据，"
+            f"累计耗时 {self.busy:.2f} 秒（单线程 {rate:.1f} MB/s）"
+        )
+
+# 同一镜像层的数据块在解压线程池中按顺序处理；待处理块数有上限，超出时下载线程等待（背压）
+class _PipelineLane:
+    def __init__(self, pipeline, func):
+        self.pipeline = pipeline
+        self.func = func
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(pipeline.max_pending)
+        self.idle = threading.Event()
+        self.idle.set()
+        self.running = False
+        self.error = None
+
+    def submit(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self.slots.acquire()
+        with self.lock:
+            self.queue.append(chunk)
+            if not self.running:
+                self.running = True
+                self.idle.clear()
+                try:
+                    self.pipeline.executor.submit(self._drain)
+                except BaseException as e:
+                    # 解压线程池已关闭（如中断后清理），不再有线程处理本通道
+                    self._abandon(e)
+                    raise
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def wait(self):
+        self.idle.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _drain(self):
+        # 每轮最多处理 max_pending 个块后重新排队，多个镜像层轮流占用解压线程
+        for _ in range(self.pipeline.max_pending):
+            with self.lock:
+                if not self.queue:
+                    self.running = False
+                    self.idle.set()
+                    return
+                chunk = self.queue.popleft()
+            start = time.time()
+            try:
+                if self.error is None:
+                    self.func(chunk)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.slots.release()
+                self.pipeline.record(len(chunk), time.time() - start)
+        try:
+            self.pipeline.executor.submit(self._drain)
+        except BaseException as e:
+            with self.lock:
+                self._abandon(e)
+
+    def _abandon(self, error):
+        # 调用方持有 self.lock；丢弃未处理的数据块并唤醒等待者，避免 wait() 永久阻塞
+        self.error = self.error or error
+        for _ in range(len(self.queue)):
+            self.slots.release()
+        self.queue.clear()
+        self.running = False
+        self.idle.set()
+
+# 下载流水线：随数据块到达同时完成摘要校验、gzip 解压与 diff_id 计算
+class LayerStream:
+    def __init__(self, digest, gz_path, tar_path, pipeline=None, compression="gzip"):
+        self.digest = digest
+        self.gz_path = gz_path
+        self.tar_path = tar_path
+        self.compression = compression
+        self.pipeline = pipeline
+        self.lane = None
+        self.resume_journal = None
+        self.gz_file = None
+        self.tar_file = None
+        self.reset()
+
+    def reset(self):
+        self.close()
+        self.lane = self.pipeline.lane(self._decompress) if self.pipeline and self.tar_path else None
+        self.gz_file = open(self.gz_path, 'wb')
+        # tar_path 为 None 时保持压缩格式，只做摘要校验
+        self.tar_file = open(self.tar_path, 'wb') if self.tar_path else None
+        self.hasher = hashlib.new(self.digest.split(':', 1)[0])
+        self.diff_hasher = hashlib.sha256()
+        self.decompressor = new_decompressor(compression=self.compression) if self.tar_path else None
+        self.offset = 0
+        self.size = 0
+        self.decompress_time = 0.0
+        self.hash_time = 0.0
+
+    def replay(self, path):
+        # 从上次运行遗留的部分文件重建状态
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                self.update(chunk)
+
+    def update(self, chunk):
+        self.gz_file.write(chunk)
+        self.process(chunk)
+
+    def process(self, chunk):
+        # 数据已由其他途径写入磁盘（如分段下载），只做校验与解压
+        start = time.perf_counter()
+        self.hasher.update(chunk)
+        self.hash_time += time.perf_counter() - start
+        self.offset += len(chunk)
+        if self.lane is not None:
+            self.lane.submit(chunk)
+        elif self.tar_file:
+            self._decompress(chunk)
+
+    def wait(self):
+        # 等待已提交的数据块解压完毕，并抛出解压线程中的异常
+        if self.lane is not None:
+            self.lane.wait()
+
+    def _decompress(self, chunk):
+        start = time.monotonic()
+        data = self.decompressor.decompress(chunk)
+        # 兼容多段 gzip 拼接（或多帧 zstd）的层文件
+        while self.decompressor.eof and self.decompressor.unused_data:
+            rest = self.decompressor.unused_data
+            data += self.decompressor.flush()
+            self.decompressor = new_decompressor(compression=self.compression)
+            data += self.decompressor.decompress(rest)
+        if data:
+            self.tar_file.write(data)
+            self.diff_hasher.update(data)
+            self.size += len(data)
+        self.decompress_time += time.monotonic() - start
+
+    def finish(self):
+        self.wait()
+        if self.tar_file:
+            data = self.decompressor.flush()
+            if data:
+                self.tar_file.write(data)
+                self.diff_hasher.update(data)
+                self.size += len(data)
+        self.close()
+
+        if not self.verify():
+            os.remove(self.gz_path)
+            if self.tar_path:
+                os.remove(self.tar_path)
+            raise ValueError(f"文件校验失败: {os.path.basename(self.gz_path)}")
+        if not self.tar_path:
+            return None
+        if not self.decompressor.eof:
+            os.remove(self.tar_path)
+            raise ValueError(f"解压失败，数据不完整: {os.path.basename(self.gz_path)}")
+        return f"sha256:{self.diff_hasher.hexdigest()}"
+
+    def verify(self):
+        return self.hasher.hexdigest() == self.digest.split(':', 1)[1]
+
+    def close(self):
+        # 通道已失败或解压线程池已关闭时不再等待，已提交的数据块不会再被处理
+        if self.lane is not None and not self.lane.failed and not self.pipeline.closed:
+            try:
+                self.lane.wait()
+            except Exception:
+                pass
+        for f in (self.gz_file, self.tar_file):
+            if f and not f.closed:
+                f.close()
+        close_decompressor = getattr(getattr(self, 'decompressor', None), 'close', None)
+        if close_decompressor:
+            close_decompressor()
+
+# 层元数据索引：解压时记录每层的 diff_id 与大小，打包阶段直接读取，无需重新计算哈希
+class LayerIndex:
+    def __init__(self, layers_dir):
+        self.layers_dir = layers_dir
+        self.path = os.path.join(layers_dir, LAYER_INDEX_FILE)
+        self.lock = threading.Lock()
+        self.order = []
+        self.layers = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.order = data.get('order', [])
+            self.layers = data.get('layers', {})
+
+    def set_order(self, digests):
+        with self.lock:
+            self.order = list(digests)
+            self._save()
+
+    def record(self, digest, tar_path, diff_id, size):
+        with self.lock:
+            self.layers[digest] = {
+                'file': os.path.basename(tar_path),
+                'diff_id': diff_id,
+                'size': size
+            }
+            self._save()
+
+    def forget(self, digest):
+        with self.lock:
+            entry = self.layers.pop(digest, None)
+            if entry is not None:
+                self._save()
+            return entry
+
+    def entries(self, digests=None):
+        digests = self.order if digests is None else digests
+        if not digests:
+            # 无索引时按目录内的层文件处理（兼容旧版工作目录）
+            return [
+                self._describe(os.path.join(self.layers_dir, l))
+                for l in sorted(os.listdir(self.layers_dir)) if l.endswith('.tar')
+            ]
+
+        entries = []
+        for digest in digests:
+            entry = self.layers.get(digest)
+            if entry is None:
+                tar_name = f"{digest.replace(':', '_').replace('/', '_')}.tar"
+                entry = self._describe(os.path.join(self.layers_dir, tar_name))
+                with self.lock:
+                    self.layers[digest] = entry
+                    self._save()
+            entries.append(dict(entry, path=os.path.join(self.layers_dir, entry['file'])))
+        return entries
+
+    def _describe(self, tar_path):
+        hasher = hashlib.sha256()
+        with profiler.span("build.rehash", os.path.getsize(tar_path)), open(tar_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return {
+            'file': os.path.basename(tar_path),
+            'path': tar_path,
+            'diff_id': f"sha256:{hasher.hexdigest()}",
+            'size': os.path.getsize(tar_path)
+        }
+
+    def _save(self):
+        # 临时文件名唯一，同一目录的多个索引实例（或进程）同时保存时不会互相覆盖到一半
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(prefix=f"{LAYER_INDEX_FILE}.", suffix=".tmp", dir=self.layers_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'order': self.order, 'layers': self.layers}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+# 本地内容寻址缓存：按摘要保存压缩层，多次拉取之间共享，超出容量时按最近最少使用淘汰
+class BlobCache:
+    def __init__(self, cache_dir, max_size=CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evicted = 0
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        self.entries = self._load()
+
+    def path(self, digest):
+        alg, digest_hex = digest.split(':', 1)
+        return os.path.join(self.cache_dir, "blobs", alg, digest_hex)
+
+    def get(self, digest):
+        path = self.path(digest)
+        with self.lock:
+            if not os.path.exists(path):
+                self.entries.pop(digest, None)
+                self.misses += 1
+                return None
+            entry = self.entries.setdefault(digest, {'size': os.path.getsize(path)})
+            entry['last_used'] = time.time()
+            self.hits += 1
+            self.bytes_saved += entry['size']
+            self._save()
+        return path
+
+    def discard(self, digest):
+        # 命中后校验失败：撤销命中统计并删除损坏的缓存项
+        with self.lock:
+            entry = self.entries.pop(digest, None)
+            if entry:
+                self.hits -= 1
+                self.misses += 1
+                self.bytes_saved -= entry['size']
+            if os.path.exists(self.path(digest)):
+                os.remove(self.path(digest))
+            self._save()
+        logger.warning(f"缓存文件校验失败，已删除: {digest[:12]}")
+
+    def put(self, digest, src_path, move=False):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if move:
+                try:
+                    os.replace(src_path, path)
+                    tmp_path = None
+                except OSError:
+                    shutil.copyfile(src_path, tmp_path)
+                    os.remove(src_path)
+            else:
+                try:
+                    os.link(src_path, tmp_path)
+                except OSError:
+                    shutil.copyfile(src_path, tmp_path)
+            if tmp_path:
+                os.replace(tmp_path, path)
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock:
+            self.entries[digest] = {'size': os.path.getsize(path), 'last_used': time.time()}
+            self._evict(keep=digest)
+            self._save()
+
+    def _evict(self, keep=None):
+        total = sum(entry['size'] for entry in self.entries.values())
+        for digest, entry in sorted(self.entries.items(), key=lambda item: item[1].get('last_used', 0)):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            if os.path.exists(self.path(digest)):
+                os.remove(self.path(digest))
+            del self.entries[digest]
+            total -= entry['size']
+            self.evicted += 1
+            logger.debug(f"缓存淘汰 {digest[:12]}（{entry['size']} 字节）")
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        total = sum(entry['size'] for entry in self.entries.values())
+        return (
+            f"缓存统计: 命中 {self.hits}/{lookups}（{hit_rate:.1f}%），"
+            f"节省下载 {self.bytes_saved / 1024 / 1024:.1f} MB，"
+            f"淘汰 {self.evicted} 项，当前占用 {total / 1024 / 1024:.1f} MB"
+        )
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning("缓存索引损坏，已重建")
+            return {}
+
+    def _save(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+# 清单缓存：按摘要保存清单原始字节，并记录 仓库/镜像@引用 → 摘要 与 ETag，
+# 标签再次解析时发送条件请求，未变化（304）时直接使用本地清单
+class ManifestCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "refs.json")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        self.refs = self._load()
+
+    def path(self, digest):
+        alg, digest_hex = digest.split(':', 1)
+        return os.path.join(self.cache_dir, "blobs", alg, digest_hex)
+
+    def get(self, digest):
+        result = self._read(digest)
+        with self.lock:
+            if result:
+                self.hits += 1
+        return result
+
+    def lookup(self, ref_key):
+        with self.lock:
+            entry = self.refs.get(ref_key)
+        if entry and os.path.exists(self.path(entry['digest'])):
+            return entry
+        return None
+
+    def revalidated(self, entry):
+        result = self._read(entry['digest'])
+        with self.lock:
+            if result:
+                self.revalidations += 1
+        return result
+
+    def store(self, ref_key, raw, media_type, etag):
+        digest = f"sha256:{hashlib.sha256(raw).hexdigest()}"
+        reference = ref_key.rsplit('@', 1)[1]
+        if reference.startswith('sha256:') and reference != digest:
+            raise ValueError(f"清单摘要不符: {reference[:19]}")
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.misses += 1
+            self.refs[ref_key] = {
+                'digest': digest,
+                'media_type': media_type,
+                'etag': etag,
+                'checked': time.time()
+            }
+            self._save()
+        return digest
+
+    def report(self):
+        return (
+            f"清单缓存: 摘要命中 {self.hits} 次，条件请求未变化 {self.revalidations} 次，"
+            f"重新下载 {self.misses} 次"
+        )
+
+    def _read(self, digest):
+        try:
+            with open(self.path(digest), 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(raw).hexdigest() != digest.split(':', 1)[1]:
+            os.remove(self.path(digest))
+            return None
+        manifest = json.loads(raw)
+        media_type = manifest.get('mediaType', '')
+        return manifest, raw, media_type
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning("清单缓存索引损坏，已重建")
+            return {}
+
+    def _save(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.refs, f)
+        os.replace(tmp_path, self.index_path)
+
+# 分段下载日志：记录已写入磁盘的分段，中断后重新运行时只下载缺失的分段。
+# hashlib/zlib 的内部状态无法序列化，续传时从本地文件重新计算摘要与解压，不再经过网络
+class SegmentJournal:
+    def __init__(self, path, digest, size, segment_size, done=None):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.segment_size = segment_size
+        self.done = set(done or [])
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, digest):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('digest') != digest:
+            return None
+        return cls(path, digest, data['size'], data['segment_size'],
+                   [tuple(segment) for segment in data.get('done', [])])
+
+    def segments(self):
+        return [
+            (start, min(start + self.segment_size, self.size) - 1)
+            for start in range(0, self.size, self.segment_size)
+        ]
+
+    def mark(self, start, end):
+        with self.lock:
+            self.done.add((start, end))
+            self.save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'digest': self.digest,
+                'size': self.size,
+                'segment_size': self.segment_size,
+                'done': sorted(self.done)
+            }, f)
+        os.replace(tmp_path, self.path)
+
+# 下载遥测：按镜像层及全局汇总字节数、吞吐、首字节时间、重试、令牌刷新与解压耗时。
+# 数据块到达时只更新计数器，渲染器按固定间隔刷新，高并发下终端输出不再占用 CPU
+class Telemetry:
+    def __init__(self, renderers=(), interval=PROGRESS_INTERVAL):
+        self.renderers = list(renderers)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.started = time.monotonic()
+        self.rendered = 0.0
+        self.expected = 0
+        self.downloaded = 0
+        self.reused = 0
+        self.retries = 0
+        self.auth_refreshes = 0
+        self.decompress_time = 0.0
+        self.blobs = {}
+
+    def expect(self, size):
+        with self.lock:
+            self.expected += size
+        self.render()
+
+    def start(self, digest, size, offset=0):
+        # offset 为续传时已在本地的字节数
+        with self.lock:
+            # 同一次运行中重新开始的层，已下载部分不再计入复用字节数
+            if digest not in self.blobs:
+                self.reused += offset
+            self.blobs[digest] = {
+                'size': size, 'bytes': offset, 'started': time.monotonic(),
+                'ttfb': None, 'retries': 0, 'state': 'downloading'
+            }
+        self._event('blob_start', digest=digest, size=size, offset=offset)
+
+    def advance(self, digest, size):
+        now = time.monotonic()
+        with self.lock:
+            self.downloaded += size
+            blob = self.blobs.get(digest)
+            if blob is not None:
+                blob['bytes'] += size
+                if blob['ttfb'] is None:
+                    blob['ttfb'] = now - blob['started']
+        if now - self.rendered >= self.interval:
+            self.render()
+
+    def retry(self, digest):
+        with self.lock:
+            self.retries += 1
+            if digest in self.blobs:
+                self.blobs[digest]['retries'] += 1
+        self._event('retry', digest=digest)
+
+    def auth_refresh(self):
+        with self.lock:
+            self.auth_refreshes += 1
+        self._event('auth_refresh')
+
+    def skip(self, digest, size, source):
+        # 已在工作目录或缓存中的层，不经过网络
+        with self.lock:
+            self.reused += size
+            self.blobs[digest] = {
+                'size': size, 'bytes': size, 'started': time.monotonic(),
+                'ttfb': None, 'retries': 0, 'state': source
+            }
+        self._event('blob_done', digest=digest, size=size, source=source)
+
+    def finish(self, digest, decompress_time=0.0):
+        with self.lock:
+            self.decompress_time += decompress_time
+            blob = self.blobs.get(digest, {})
+            blob['state'] = 'done'
+            blob['elapsed'] = time.monotonic() - blob.get('started', self.started)
+            blob['decompress_time'] = decompress_time
+        self._event('blob_done', digest=digest, size=blob.get('size'), source='registry',
+                    elapsed=round(blob['elapsed'], 3), ttfb=_round(blob.get('ttfb')),
+                    decompress_time=round(decompress_time, 3))
+
+    def fail(self, digest, error):
+        with self.lock:
+            if digest in self.blobs:
+                self.blobs[digest]['state'] = 'failed'
+        self._event('blob_failed', digest=digest, error=str(error))
+
+    def discard(self, digests):
+        # 常驻进程中不再需要的层从逐层统计中移除，累计计数保持不变
+        with self.lock:
+            for digest in digests:
+                self.blobs.pop(digest, None)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            blobs = {digest: dict(blob) for digest, blob in self.blobs.items()}
+            return {
+                'elapsed': elapsed,
+                'expected': self.expected,
+                'completed': sum(blob['bytes'] for blob in blobs.values()),
+                'downloaded': self.downloaded,
+                'reused': self.reused,
+                'throughput': self.downloaded / elapsed if elapsed else 0.0,
+                'blobs': blobs,
+                'blobs_done': sum(1 for blob in blobs.values() if blob['state'] != 'downloading'),
+                'retries': self.retries,
+                'auth_refreshes': self.auth_refreshes,
+                'decompress_time': self.decompress_time
+            }
+
+    def render(self, force=False):
+        if not self.renderers:
+            return
+        # 其他线程正在渲染时直接返回，不阻塞下载
+        if not self.render_lock.acquire(blocking=force):
+            return
+        try:
+            self.rendered = time.monotonic()
+            snapshot = self.snapshot()
+            for renderer in self.renderers:
+                renderer.update(snapshot)
+        finally:
+            self.render_lock.release()
+
+    def close(self):
+        self.render(force=True)
+        snapshot = self.snapshot()
+        for renderer in self.renderers:
+            renderer.close(snapshot)
+
+    def _event(self, name, **fields):
+        for renderer in self.renderers:
+            renderer.event(name, fields)
+        if name != 'blob_start' and time.monotonic() - self.rendered >= self.interval:
+            self.render()
+
+def _round(value, digits=3):
+    return None if value is None else round(value, digits)
+
+def _telemetry(session):
+    return getattr(session, 'telemetry', None) or _NO_TELEMETRY
+
+# 未配置遥测时使用的空实现：不保存任何状态，可在所有会话与线程间共享
+class _NullTelemetry(Telemetry):
+    def expect(self, size):
+        pass
+
+    def start(self, digest, size, offset=0):
+        pass
+
+    def advance(self, digest, size):
+        pass
+
+    def retry(self, digest):
+        pass
+
+    def auth_refresh(self):
+        pass
+
+    def skip(self, digest, size, source):
+        pass
+
+    def finish(self, digest, decompress_time=0.0):
+        pass
+
+    def fail(self, digest, error):
+        pass
+
+_NO_TELEMETRY = _NullTelemetry()
+
+# 单个汇总进度条，替代每层一个 tqdm
+class BarRenderer:
+    def __init__(self):
+        from tqdm import tqdm
+        self.pbar = tqdm(total=0, unit='B', unit_scale=True, desc="下载", mininterval=0)
+
+    def update(self, snapshot):
+        self.pbar.total = max(snapshot['expected'], snapshot['completed'])
+        self.pbar.n = snapshot['completed']
+        self.pbar.set_postfix_str(
+            f"层 {snapshot['blobs_done']}/{len(snapshot['blobs'])} 重试 {snapshot['retries']}", refresh=False
+        )
+        self.pbar.refresh()
+
+    def event(self, name, fields):
+        pass
+
+    def close(self, snapshot):
+        self.update(snapshot)
+        self.pbar.close()
+
+# 非终端环境（CI 日志）每隔一段时间输出一行进度
+class LogRenderer:
+    def __init__(self, interval=PROGRESS_LOG_INTERVAL):
+        self.interval = interval
+        self.logged = time.monotonic()
+
+    def update(self, snapshot):
+        if time.monotonic() - self.logged < self.interval:
+            return
+        self.logged = time.monotonic()
+        logger.info(
+            f"进度: {snapshot['completed'] / 1024 / 1024:.1f}/{snapshot['expected'] / 1024 / 1024:.1f} MB，"
+            f"{snapshot['throughput'] / 1024 / 1024:.1f} MB/s，"
+            f"层 {snapshot['blobs_done']}/{len(snapshot['blobs'])}，重试 {snapshot['retries']}"
+        )
+
+    def event(self, name, fields):
+        pass
+
+    def close(self, snapshot):
+        pass
+
+# JSON Lines 事件流：每个事件及周期性进度快照各占一行
+class JsonLinesRenderer:
+    def __init__(self, path=None):
+        self.file = open(path, 'a', encoding='utf-8') if path else sys.stdout
+        self.lock = threading.Lock()
+
+    def update(self, snapshot):
+        self._write('progress', _summary(snapshot))
+
+    def event(self, name, fields):
+        self._write(name, fields)
+
+    def close(self, snapshot):
+        self._write('summary', _summary(snapshot))
+        if self.file is not sys.stdout:
+            self.file.close()
+
+    def _write(self, name, fields):
+        line = json.dumps({'event': name, 'time': round(time.time(), 3), **fields}, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+def _summary(snapshot):
+    return {
+        'elapsed': round(snapshot['elapsed'], 3),
+        'expected': snapshot['expected'],
+        'completed': snapshot['completed'],
+        'downloaded': snapshot['downloaded'],
+        'throughput': round(snapshot['throughput']),
+        'blobs': len(snapshot['blobs']),
+        'blobs_done': snapshot['blobs_done'],
+        'retries': snapshot['retries'],
+        'auth_refreshes': snapshot['auth_refreshes'],
+        'decompress_time': round(snapshot['decompress_time'], 3)
+    }
+
+# Prometheus 文本文件（node_exporter textfile collector 格式），原子替换写入
+class PrometheusRenderer:
+    def __init__(self, path):
+        self.path = path
+
+    def update(self, snapshot):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(prometheus_text(snapshot))
+        os.replace(tmp_path, self.path)
+
+    def event(self, name, fields):
+        pass
+
+    def close(self, snapshot):
+        self.update(snapshot)
+
+def prometheus_text(snapshot):
+    lines = [
+        "# TYPE docker_pull_bytes_expected gauge",
+        f"docker_pull_bytes_expected {snapshot['expected']}",
+        "# TYPE docker_pull_bytes_downloaded_total counter",
+        f"docker_pull_bytes_downloaded_total {snapshot['downloaded']}",
+        "# TYPE docker_pull_bytes_reused_total counter",
+        f"docker_pull_bytes_reused_total {snapshot['reused']}",
+        "# TYPE docker_pull_throughput_bytes_per_second gauge",
+        f"docker_pull_throughput_bytes_per_second {snapshot['throughput']:.0f}",
+        "# TYPE docker_pull_retries_total counter",
+        f"docker_pull_retries_total {snapshot['retries']}",
+        "# TYPE docker_pull_auth_refreshes_total counter",
+        f"docker_pull_auth_refreshes_total {snapshot['auth_refreshes']}",
+        "# TYPE docker_pull_decompress_seconds_total counter",
+        f"docker_pull_decompress_seconds_total {snapshot['decompress_time']:.3f}",
+        "# TYPE docker_pull_elapsed_seconds gauge",
+        f"docker_pull_elapsed_seconds {snapshot['elapsed']:.3f}",
+        "# TYPE docker_pull_blob_bytes gauge",
+    ]
+    for digest, blob in snapshot['blobs'].items():
+        lines.append(f'docker_pull_blob_bytes{{digest="{digest}",state="{blob["state"]}"}} {blob["bytes"]}')
+    lines.append("# TYPE docker_pull_blob_ttfb_seconds gauge")
+    for digest, blob in snapshot['blobs'].items():
+        if blob['ttfb'] is not None:
+            lines.append(f'docker_pull_blob_ttfb_seconds{{digest="{digest}"}} {blob["ttfb"]:.3f}')
+    return '\n'.join(lines) + '\n'
+
+def create_telemetry(progress="auto", progress_file=None, metrics_file=None, interval=PROGRESS_INTERVAL):
+    if progress == "auto":
+        progress = "bar" if sys.stderr.isatty() else "log"
+    renderers = []
+    if progress == "bar":
+        renderers.append(BarRenderer())
+    elif progress == "log":
+        renderers.append(LogRenderer())
+    elif progress == "jsonl":
+        renderers.append(JsonLinesRenderer(progress_file))
+    if metrics_file:
+        renderers.append(PrometheusRenderer(metrics_file))
+    return Telemetry(renderers, interval)
+
+# 性能剖析：按阶段统计墙钟时间、字节数与峰值内存，可选 cProfile 与 tracemalloc。
+# 顶层阶段（清单解析、下载、打包）依次执行，各自统计峰值内存；阶段内的子步骤可能在多个线程中并发，
+# 墙钟时间取各次调用时间区间的并集，累计时间为各次调用之和
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.memory = False
+        self.profiles = []
+
+    def enable(self, cprofile=False, memory=False):
+        self.enabled = True
+        self.started = time.perf_counter()
+        if memory:
+            import tracemalloc
+            tracemalloc.start()
+            self.memory = True
+        if cprofile:
+            import cProfile
+            if sys.version_info >= (3, 12):
+                # 3.12 起 cProfile 基于 sys.monitoring，一个实例即覆盖所有线程
+                profile = cProfile.Profile()
+                profile.enable()
+                self.profiles.append(profile)
+            else:
+                # 之前的版本只剖析调用 enable 的线程，为每个新线程各建一个实例，最后合并
+                def start_thread_profile(*args):
+                    profile = cProfile.Profile()
+                    with self.lock:
+                        self.profiles.append(profile)
+                    profile.enable()
+
+                threading.setprofile(start_thread_profile)
+                profile = cProfile.Profile()
+                profile.enable()
+                self.profiles.append(profile)
+
+    def phase(self, name, size=0):
+        return _Span(self, name, size, top=True) if self.enabled else _NULL_SPAN
+
+    def span(self, name, size=0):
+        return _Span(self, name, size) if self.enabled else _NULL_SPAN
+
+    def add(self, name, seconds, size=0):
+        # 热路径中累计的耗时（如逐块摘要计算），没有时间区间
+        if self.enabled:
+            with self.lock:
+                stat = self._stat(name)
+                stat['count'] += 1
+                stat['busy'] += seconds
+                stat['bytes'] += size
+
+    def record(self, name, start, end, size, memory=None):
+        with self.lock:
+            stat = self._stat(name)
+            stat['count'] += 1
+            stat['busy'] += end - start
+            stat['bytes'] += size
+            stat['intervals'].append((start, end))
+            stat['first'] = min(stat['first'], start)
+            if memory:
+                stat.update(memory)
+
+    def report(self):
+        rows = []
+        with self.lock:
+            # 按首次开始时间排序，顶层阶段排在其子步骤之前
+            for name, stat in sorted(self.stats.items(), key=lambda item: item[1]['first']):
+                wall = _interval_union(stat['intervals']) if stat['intervals'] else stat['busy']
+                rows.append({
+                    'phase': name,
+                    'count': stat['count'],
+                    'wall': round(wall, 4),
+                    'busy': round(stat['busy'], 4),
+                    'bytes': stat['bytes'],
+                    'mb_per_s': round(stat['bytes'] / 1024 / 1024 / wall, 2) if stat['bytes'] and wall else None,
+                    'peak_rss': stat.get('peak_rss'),
+                    'peak_traced': stat.get('peak_traced')
+                })
+        return {'elapsed': round(time.perf_counter() - self.started, 4), 'phases': rows}
+
+    def table(self, report):
+        def mb(value):
+            return "-" if value is None else f"{value / 1024 / 1024:.1f}"
+
+        header = f"{'阶段':<20}{'次数':>6}{'墙钟(s)':>10}{'累计(s)':>10}{'MB':>10}{'MB/s':>9}{'峰值内存(MB)':>14}"
+        lines = [header + (f"{'Python峰值(MB)':>16}" if self.memory else "")]
+        for row in report['phases']:
+            lines.append(
+                f"{row['phase']:<20}{row['count']:>6}{row['wall']:>10.3f}{row['busy']:>10.3f}"
+                f"{mb(row['bytes'] or None):>10}{'-' if row['mb_per_s'] is None else row['mb_per_s']:>9}"
+                f"{mb(row['peak_rss']):>14}" + (f"{mb(row['peak_traced']):>16}" if self.memory else "")
+            )
+        lines.append(f"总耗时 {report['elapsed']:.3f} 秒")
+        return '\n'.join(lines)
+
+    def dump_cprofile(self, path):
+        import pstats
+        threading.setprofile(None)
+        # 当前线程的实例最后处理，避免提前停止其剖析
+        stats = None
+        for profile in reversed(self.profiles):
+            profile.disable()
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is not None:
+            stats.dump_stats(path)
+        return stats
+
+    def _stat(self, name):
+        if name not in self.stats:
+            self.stats[name] = {'count': 0, 'busy': 0.0, 'bytes': 0, 'intervals': [], 'first': time.perf_counter()}
+        return self.stats[name]
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'bytes', 'top', 'start')
+
+    def __init__(self, profiler, name, size=0, top=False):
+        self.profiler = profiler
+        self.name = name
+        self.bytes = size
+        self.top = top
+
+    def __enter__(self):
+        if self.top:
+            _reset_peak_memory(self.profiler.memory)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        memory = _peak_memory(self.profiler.memory) if self.top else None
+        self.profiler.record(self.name, self.start, end, self.bytes, memory)
+
+class _NullSpan:
+    # 未启用剖析时的空实现，允许设置 bytes 但不记录
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def _interval_union(intervals):
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+def _reset_peak_memory(traced):
+    # Linux 上写入 clear_refs 可重置 VmHWM（进程峰值常驻内存）
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        pass
+    if traced:
+        import tracemalloc
+        tracemalloc.reset_peak()
+
+def _peak_memory(traced):
+    memory = {}
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    memory['peak_rss'] = int(line.split()[1]) * 1024
+    except OSError:
+        try:
+            import resource
+            # 非 Linux 平台无法按阶段重置，给出进程启动以来的峰值（macOS 单位为字节）
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            memory['peak_rss'] = peak if sys.platform == 'darwin' else peak * 1024
+        except ImportError:
+            pass
+    if traced:
+        import tracemalloc
+        memory['peak_traced'] = tracemalloc.get_traced_memory()[1]
+    return memory
+
+profiler = Profiler()
+
+# 全局令牌桶限速：所有线程/协程共享，每个数据块按到达顺序预约额度，额度不足时等待
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, CHUNK_SIZE)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        # 允许额度为负，返回需要等待的秒数，先到的数据块先获得额度
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def consume(self, size):
+        wait = self.reserve(size)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def consume_async(self, size):
+        wait = self.reserve(size)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+# 同一批下载中某一层失败或用户中断时置位，其余下载线程在下一个数据块处退出（已写入的部分保留供续传）
+class DownloadCancelled(Exception):
+    pass
+
+def _check_stop(stop):
+    if stop is not None and stop.is_set():
+        raise DownloadCancelled("下载已取消")
+
+def _retry_wait(stop, delay):
+    if stop is None:
+        time.sleep(delay)
+    elif stop.wait(delay):
+        raise DownloadCancelled("下载已取消")
+
+def _throttle(session, size):
+    limiter = getattr(session, 'rate_limiter', None)
+    if limiter is not None:
+        limiter.consume(size)
+
+def schedule_jobs(jobs, output_dir, schedule="largest"):
+    # 返回提交顺序（jobs 下标）：largest 按剩余字节从大到小，避免最大的层最后才开始而拉长总耗时；
+    # smallest 为最短剩余优先，尽快完成小层；manifest 保持清单顺序
+    if schedule == "manifest":
+        return list(range(len(jobs)))
+
+    def remaining(idx):
+        layer = jobs[idx][2]
+        sanitized_name = layer['digest'].replace(':', '_').replace('/', '_')
+        partial = os.path.join(output_dir, f"{sanitized_name}.tar.gz.download")
+        done = os.path.getsize(partial) if os.path.exists(partial) else 0
+        return max(layer.get('size', 0) - done, 0)
+
+    return sorted(range(len(jobs)), key=remaining, reverse=schedule == "largest")
+
+def _blob_url(registry, repo, img, digest):
+    return f"https://{registry}/v2/{repo}/{img}/blobs/{digest}"
+
+def _open_blob(session, registry, repo, img, digest, byte_range=None):
+    for _ in range(2):
+        headers = get_auth_token(session, registry, repo, img).copy()
+        if byte_range:
+            headers['Range'] = byte_range
+        resp = session.get(
+            _blob_url(registry, repo, img, digest),
+            headers=headers,
+            stream=True,
+            verify=session.verify,
+            timeout=30
+        )
+        if resp.status_code != 401:
+            return resp
+        resp.close()
+        _telemetry(session).auth_refresh()
+        get_auth_token(session, registry, repo, img, force_refresh=True)
+    resp.raise_for_status()
+
+def _download_sequential(session, registry, repo, img, layer_digest, stream, first_resp=None, stop=None):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            if first_resp is not None:
+                resp, first_resp = first_resp, None
+            else:
+                byte_range = f'bytes={stream.offset}-' if stream.offset > 0 else None
+                resp = _open_blob(session, registry, repo, img, layer_digest, byte_range)
+
+            with resp:
+                if resp.status_code == 416 and stream.offset > 0:
+                    # 已下载完整，仅剩收尾
+                    return
+
+                resp.raise_for_status()
+                if stream.offset > 0 and (resp.status_code != 206
+                                          or _content_range_start(resp) != stream.offset):
+                    logger.warning(f"服务器不支持断点续传，重新下载 {layer_digest[:12]}")
+                    stream.reset()
+
+                telemetry = _telemetry(session)
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    _check_stop(stop)
+                    if chunk:
+                        stream.update(chunk)
+                        telemetry.advance(layer_digest, len(chunk))
+                        _throttle(session, len(chunk))
+            return
+
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            # 流水线状态（哈希器、解压器、偏移量）保留在内存中，直接从断点续传
+            _telemetry(session).retry(layer_digest)
+            logger.warning(f"下载中断 {layer_digest[:12]}（{str(e)}），从 {stream.offset} 字节处继续")
+            _retry_wait(stop, RETRY_DELAY * (RETRY_BACKOFF ** attempt))
+
+def _content_range_start(resp):
+    content_range = resp.headers.get('Content-Range', '')
+    if not content_range.startswith('bytes '):
+        return None
+    return int(content_range[6:].split('-', 1)[0])
+
+def _pwrite(fd, data, offset, lock):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+def _fetch_segment(session, registry, repo, img, layer_digest, fd, lock, start, end, resp=None,
+                   journal=None, stop=None):
+    telemetry = _telemetry(session)
+    pos = start
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            if resp is None:
+                resp = _open_blob(session, registry, repo, img, layer_digest, f'bytes={pos}-{end}')
+            with resp:
+                resp.raise_for_status()
+                if resp.status_code != 206 or _content_range_start(resp) != pos:
+                    raise ValueError(f"分段响应与请求范围不符: {layer_digest[:12]} bytes={pos}-{end}")
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    _check_stop(stop)
+                    if chunk:
+                        chunk = chunk[:end + 1 - pos]
+                        written = 0
+                        while written < len(chunk):
+                            written += _pwrite(fd, chunk[written:], pos + written, lock)
+                        pos += len(chunk)
+                        telemetry.advance(layer_digest, len(chunk))
+                        _throttle(session, len(chunk))
+            if pos > end:
+                if journal is not None:
+                    journal.mark(start, end)
+                return
+            raise requests.exceptions.ChunkedEncodingError(f"分段数据不完整: {pos}/{end + 1}")
+
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            telemetry.retry(layer_digest)
+            logger.warning(f"分段下载中断 {layer_digest[:12]}（{str(e)}），从 {pos} 字节处继续")
+            _retry_wait(stop, RETRY_DELAY * (RETRY_BACKOFF ** attempt))
+        finally:
+            resp = None
+
+def _process_segment(reader, stream, start, end):
+    # reader 须为无缓冲读取（buffering=0）：其余分段仍在并发写入，带缓冲的读取会预读到尚未写入的空洞，
+    # 之后 seek 落在缓冲区内时读到的是旧的零字节
+    reader.seek(start)
+    remaining = end + 1 - start
+    while remaining > 0:
+        chunk = reader.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise IOError(f"分段文件读取不完整: {stream.digest[:12]}")
+        stream.process(chunk)
+        remaining -= len(chunk)
+
+def _resume_segments(stream):
+    # 把上次运行保留的分段文件放回原位，返回其下载日志
+    journal = stream.resume_journal
+    stream.gz_file.close()
+    os.replace(f"{stream.gz_path}.segments", stream.gz_path)
+    stream.gz_file = open(stream.gz_path, 'r+b')
+    logger.info(f"按下载日志续传 {stream.digest[:12]}：已完成 {len(journal.done)}/{len(journal.segments())} 个分段")
+    return journal
+
+def _allocate_segments(stream, blob_size, segment_size):
+    # 先写入空的下载日志再预分配文件，任何分段完成前中断也不会把预分配的空洞当作已下载的前缀
+    journal = SegmentJournal(f"{stream.gz_path}.journal", stream.digest, blob_size, segment_size)
+    journal.save()
+    stream.gz_file.flush()
+    fd = os.open(stream.gz_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, 0, blob_size)
+    else:
+        os.ftruncate(fd, blob_size)
+    return fd, journal
+
+def _close_segments(fd, stream, journal, blob_size):
+    # 完成后删除日志；中断时保留完整大小的分段文件与日志，下次运行据此续传
+    os.close(fd)
+    if stream.offset >= blob_size:
+        journal.remove()
+    stream.gz_file.seek(stream.offset)
+
+def _download_segmented(session, registry, repo, img, layer_digest, blob_size, stream,
+                        segment_size, segment_workers, stop=None):
+    first_resp = None
+    if stream.resume_journal is not None:
+        journal = _resume_segments(stream)
+        fd = os.open(stream.gz_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    else:
+        # 先发出第一个分段请求，服务器忽略 Range 时直接把该响应当作整段下载使用
+        first_end = min(segment_size, blob_size) - 1
+        first_resp = _open_blob(session, registry, repo, img, layer_digest, f'bytes=0-{first_end}')
+        if first_resp.status_code != 206:
+            logger.info(f"服务器不支持分段下载，改为单连接下载 {layer_digest[:12]}")
+            _download_sequential(session, registry, repo, img, layer_digest, stream, first_resp, stop)
+            return
+        fd, journal = _allocate_segments(stream, blob_size, segment_size)
+    segments = journal.segments()
+    lock = threading.Lock()
+    try:
+
+        with ThreadPoolExecutor(max_workers=segment_workers) as executor, \
+                open(stream.gz_path, 'rb', buffering=0) as reader:
+            futures = [
+                None if (start, end) in journal.done else executor.submit(
+                    _fetch_segment, session, registry, repo, img, layer_digest,
+                    fd, lock, start, end, first_resp if idx == 0 else None, journal, stop
+                )
+                for idx, (start, end) in enumerate(segments)
+            ]
+            try:
+                # 按顺序等待分段完成，并将已完成的连续前缀送入校验/解压流水线
+                for future, (start, end) in zip(futures, segments):
+                    if future is not None:
+                        future.result()
+                    _process_segment(reader, stream, start, end)
+            except BaseException:
+                for future in futures:
+                    if future is not None:
+                        future.cancel()
+                raise
+    finally:
+        _close_segments(fd, stream, journal, blob_size)
+
+def _open_layer_stream(layer_digest, output_dir, decompress=True, pipeline=None, compression="gzip"):
+    sanitized_name = layer_digest.replace(':', '_').replace('/', '_')
+    tmp_gz = os.path.join(output_dir, f"{sanitized_name}.tar.gz.download")
+    if decompress:
+        tar_path = os.path.join(output_dir, f"{sanitized_name}.tar")
+    else:
+        tar_path = blob_path(output_dir, layer_digest)
+
+    # 有分段下载日志时按分段续传，否则把已有文件当作连续前缀重放
+    journal = SegmentJournal.load(f"{tmp_gz}.journal", layer_digest)
+    if journal and os.path.exists(tmp_gz) and os.path.getsize(tmp_gz) == journal.size:
+        os.replace(tmp_gz, f"{tmp_gz}.segments")
+    elif journal:
+        journal.remove()
+        journal = None
+
+    partial_gz = None
+    if journal is None and os.path.exists(tmp_gz) and os.path.getsize(tmp_gz) > 0:
+        partial_gz = f"{tmp_gz}.partial"
+        os.replace(tmp_gz, partial_gz)
+
+    stream = LayerStream(
+        layer_digest, tmp_gz, f"{tar_path}.download" if decompress else None, pipeline, compression
+    )
+    stream.resume_journal = journal
+    if partial_gz:
+        try:
+            logger.info(f"恢复未完成的下载 {layer_digest[:12]}...")
+            stream.replay(partial_gz)
+            os.remove(partial_gz)
+        except Exception:
+            _discard_layer_stream(stream)
+            raise
+    return stream, tar_path
+
+def _extract_cached_blob(stream, cache):
+    # 缓存命中时直接从本地压缩层解压，校验与解压在同一遍读取中完成
+    cached_path = cache.get(stream.digest)
+    if not cached_path:
+        return False
+    # 保持压缩格式时将缓存文件复制到工作目录，复制与校验同样只读一遍
+    feed = stream.process if stream.tar_path else stream.update
+    try:
+        with profiler.span("download.cache", os.path.getsize(cached_path)), open(cached_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                feed(chunk)
+            stream.wait()
+        if stream.verify():
+            logger.info(f"缓存命中 {stream.digest[:12]}")
+            return True
+    except (OSError,) + decompress_errors():
+        pass
+    cache.discard(stream.digest)
+    stream.reset()
+    return False
+
+def _finish_layer_stream(stream, tar_path, layer_index, cache=None, from_cache=False):
+    diff_id = stream.finish()
+    profiler.add("download.verify", stream.hash_time, stream.offset)
+    if stream.tar_path:
+        profiler.add("download.decompress", stream.decompress_time, stream.size)
+    if not stream.tar_path:
+        if cache is not None and not from_cache:
+            cache.put(stream.digest, stream.gz_path)
+        os.replace(stream.gz_path, tar_path)
+        logger.info(f"已下载 {stream.digest[:12]}（{stream.offset} 字节）")
+        return tar_path
+
+    if cache is not None and not from_cache:
+        cache.put(stream.digest, stream.gz_path, move=True)
+    else:
+        os.remove(stream.gz_path)
+    os.replace(stream.tar_path, tar_path)
+    if layer_index is not None:
+        layer_index.record(stream.digest, tar_path, diff_id, stream.size)
+    logger.info(f"已解压 {stream.digest[:12]}（diff_id {diff_id[7:19]}）")
+    return tar_path
+
+def _discard_layer_stream(stream):
+    stream.close()
+    if stream.tar_path and os.path.exists(stream.tar_path):
+        os.remove(stream.tar_path)
+
+def blob_path(output_dir, digest):
+    return os.path.join(output_dir, f"{digest.replace(':', '_').replace('/', '_')}.blob")
+
+def is_layer_descriptor(descriptor):
+    media_type = descriptor.get('mediaType', '')
+    return 'layer' in media_type or 'rootfs' in media_type or not media_type
+
+def _resumed_bytes(stream):
+    if stream.resume_journal is not None:
+        return sum(end + 1 - start for start, end in stream.resume_journal.done)
+    return stream.offset
+
+def _completed_layer_path(layer, output_dir, layer_index, decompress):
+    # 保留的工作目录中已完成的层（上次运行中断前下载完毕）直接复用
+    digest = layer['digest']
+    if decompress and is_layer_descriptor(layer):
+        entry = layer_index.layers.get(digest) if layer_index is not None else None
+        path = os.path.join(output_dir, entry['file']) if entry else None
+        if path and os.path.exists(path) and os.path.getsize(path) == entry['size']:
+            logger.info(f"已存在，跳过 {digest[:12]}")
+            return path
+        return None
+    path = blob_path(output_dir, digest)
+    if os.path.exists(path) and os.path.getsize(path) == layer.get('size'):
+        logger.info(f"已存在，跳过 {digest[:12]}")
+        return path
+    return None
+
+def download_layer(session, registry, repo, img, layer, output_dir, auth_headers, layer_index=None,
+                   segment_size=SEGMENT_SIZE, segment_workers=SEGMENT_WORKERS, cache=None,
+                   decompress=True, pipeline=None, stop=None):
+    layer_digest = layer['digest']
+    blob_size = layer.get('size', 0)
+    telemetry = _telemetry(session)
+    completed = _completed_layer_path(layer, output_dir, layer_index, decompress)
+    if completed:
+        telemetry.skip(layer_digest, blob_size, 'local')
+        return completed
+    stream, tar_path = _open_layer_stream(
+        layer_digest, output_dir, decompress, pipeline, layer_compression(layer)
+    )
+    try:
+        resuming = stream.resume_journal is not None
+        if cache is not None and stream.offset == 0 and not resuming and _extract_cached_blob(stream, cache):
+            telemetry.skip(layer_digest, blob_size, 'cache')
+            return _finish_layer_stream(stream, tar_path, layer_index, cache, from_cache=True)
+
+        telemetry.start(layer_digest, blob_size, _resumed_bytes(stream))
+        with profiler.span("download.network", blob_size - _resumed_bytes(stream)):
+            if resuming or (stream.offset == 0 and segment_workers > 1 and blob_size >= segment_size * 2):
+                _download_segmented(
+                    session, registry, repo, img, layer_digest, blob_size, stream,
+                    segment_size, segment_workers, stop
+                )
+            else:
+                _download_sequential(session, registry, repo, img, layer_digest, stream, stop=stop)
+        layer_file = _finish_layer_stream(stream, tar_path, layer_index, cache)
+        telemetry.finish(layer_digest, stream.decompress_time)
+        return layer_file
+    except Exception as e:
+        telemetry.fail(layer_digest, e)
+        _discard_layer_stream(stream)
+        raise
+
+def download_layer_jobs(session, registry, jobs, output_dir, layer_index=None, workers=MAX_WORKERS,
+                        segment_size=SEGMENT_SIZE, segment_workers=SEGMENT_WORKERS, cache=None,
+                        decompress=True, schedule="largest", decompress_workers=None):
+    # jobs 为 (repo, img, layer) 列表，可来自不同镜像，共用同一个线程池与会话；
+    # 配置文件等非层对象始终按原样保存；按 schedule 顺序提交，结果仍按 jobs 顺序返回
+    # decompress_workers 为 0 时在下载线程内直接解压
+    pipeline = DecompressPipeline(decompress_workers) if decompress and decompress_workers != 0 else None
+    executor = ThreadPoolExecutor(max_workers=workers)
+    stop = threading.Event()
+    try:
+        return _run_layer_jobs(
+            session, registry, jobs, output_dir, layer_index, executor, segment_size,
+            segment_workers, cache, decompress, schedule, pipeline, stop
+        )
+    finally:
+        # 出错或中断时通知仍在下载的线程在下一个数据块处退出，取消尚未开始的层；
+        # 先等待下载线程全部退出再关闭解压线程池，否则仍在运行的下载线程无法再提交数据块
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        if pipeline is not None:
+            pipeline.shutdown()
+            logger.info(pipeline.report())
+
+def _run_layer_jobs(session, registry, jobs, output_dir, layer_index, executor, segment_size,
+                    segment_workers, cache, decompress, schedule, pipeline, stop):
+    _telemetry(session).expect(sum(layer.get('size', 0) for _, _, layer in jobs))
+    futures = {}
+    for job_idx in schedule_jobs(jobs, output_dir, schedule):
+        repo, img, layer = jobs[job_idx]
+        futures[job_idx] = executor.submit(
+            download_layer,
+            session=session,
+            registry=registry,
+            repo=repo,
+            img=img,
+            layer=layer,
+            output_dir=output_dir,
+            auth_headers=None,
+            layer_index=layer_index,
+            segment_size=segment_size,
+            segment_workers=segment_workers,
+            cache=cache,
+            decompress=decompress and is_layer_descriptor(layer),
+            pipeline=pipeline,
+            stop=stop
+        )
+
+    # 按完成顺序检查结果，任一层失败立即通知其余层停止；配置等非层对象不计入层数
+    total_layers = sum(1 for _, _, layer in jobs if is_layer_descriptor(layer))
+    done_layers = 0
+    indexes = {future: idx for idx, future in futures.items()}
+    layer_files = [None] * len(jobs)
+    try:
+        for future in as_completed(indexes):
+            idx = indexes[future]
+            layer_files[idx] = future.result()
+            if is_layer_descriptor(jobs[idx][2]):
+                done_layers += 1
+                logger.info(f"已完成第 {done_layers}/{total_layers} 层")
+    except BaseException as e:
+        # 已写入磁盘的部分保留供下次续传
+        stop.set()
+        if not isinstance(e, KeyboardInterrupt):
+            logger.error(f"镜像层下载失败: {str(e)}")
+        raise
+    return layer_files
+
+# asyncio 下载引擎：单线程内以协程并发大量分段/镜像层请求（依赖可选的 aiohttp）
+class AsyncBlobFetcher:
+    def __init__(self, http, registry, repo, img, host_limit, semaphores=None, token_manager=None,
+                 rate_limiter=None, telemetry=None, verify=True):
+        self.http = http
+        # aiohttp 的 ssl=None 表示按默认方式校验证书，False 表示跳过校验
+        self.ssl = None if verify else False
+        self.rate_limiter = rate_limiter
+        self.telemetry = telemetry or _NO_TELEMETRY
+        self.registry = registry
+        self.repo = repo
+        self.img = img
+        self.host_limit = host_limit
+        self.token = None
+        self.token_exp = 0
+        self.token_lock = asyncio.Lock()
+        # 与线程池引擎共用令牌管理器，复用已缓存的质询与令牌
+        self.token_manager = TokenManager() if token_manager is None else token_manager
+        # 同一事件循环中的多个镜像共享按主机划分的并发信号量
+        self.semaphores = {} if semaphores is None else semaphores
+
+    def _semaphore(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.BoundedSemaphore(self.host_limit)
+        return self.semaphores[host]
+
+    async def auth_headers(self, force_refresh=False):
+        async with self.token_lock:
+            if not force_refresh and self.token and self.token_exp > time.time() + TOKEN_EXPIRY_MARGIN:
+                return {'Authorization': f'Bearer {self.token}'}
+            cached = self.token_manager.cached(self.registry, self.repo, self.img)
+            if not force_refresh and cached:
+                self.token, self.token_exp = cached['token'], cached['expires']
+                return {'Authorization': f'Bearer {self.token}'}
+
+            with profiler.span("auth"):
+                # 与 TokenManager 相同：收到 401 后重新探测认证质询，缓存的质询取不到令牌时也重新探测一次
+                challenge = self.token_manager.challenge(self.registry)
+                probed = challenge is None or force_refresh
+                if probed:
+                    challenge = await self._probe_challenge()
+                if not challenge:
+                    return {}
+                try:
+                    token, expires_in = await self._request_token(challenge)
+                except (optional_module("aiohttp").ClientError, ValueError, KeyError) as e:
+                    if probed:
+                        raise
+                    logger.debug(f"使用缓存的认证质询获取令牌失败（{str(e)}），重新探测 {self.registry}")
+                    challenge = await self._probe_challenge()
+                    if not challenge:
+                        return {}
+                    token, expires_in = await self._request_token(challenge)
+
+                self.token = token
+                self.token_exp = time.time() + expires_in
+                self.token_manager.store(self.registry, self.repo, self.img, self.token, expires_in)
+                logger.debug(f"异步引擎获取新令牌前8位: {self.token[:8]}******")
+                return {'Authorization': f'Bearer {self.token}'}
+
+    async def _probe_challenge(self):
+        async with self.http.get(f"https://{self.registry}/v2/", ssl=self.ssl) as resp:
+            challenge = {}
+            if resp.status == 401:
+                challenge = parse_auth_challenge(resp.headers.get('Www-Authenticate', ''))
+        self.token_manager.set_challenge(self.registry, challenge)
+        return challenge
+
+    async def _request_token(self, challenge):
+        token_url = (f"{challenge['realm']}?service={challenge['service']}"
+                     f"&scope=repository:{self.repo}/{self.img}:pull")
+        async with self.http.get(token_url, ssl=self.ssl) as resp:
+            resp.raise_for_status()
+            token_data = await resp.json(content_type=None)
+        return token_data["token"], token_data.get('expires_in', 3600)
+
+    async def fetch(self, digest, start, end, on_chunk):
+        # 拉取 [start, end] 字节范围（end 为 None 表示到结尾），返回实际起始偏移；服务器忽略 Range 时返回 0
+        url = _blob_url(self.registry, self.repo, self.img, digest)
+        async with self._semaphore(self.registry):
+            for _ in range(2):
+                headers = dict(await self.auth_headers())
+                if start > 0 or end is not None:
+                    headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+                async with self.http.get(url, headers=headers, ssl=self.ssl) as resp:
+                    if resp.status == 401:
+                        self.telemetry.auth_refresh()
+                        await self.auth_headers(force_refresh=True)
+                        continue
+                    if resp.status == 416 and start > 0 and end is None:
+                        return start
+                    resp.raise_for_status()
+
+                    offset = start
+                    if resp.status != 206:
+                        offset = 0
+                    elif _content_range_start(resp) != start:
+                        raise ValueError(f"分段响应与请求范围不符: {digest[:12]} bytes={start}-{end}")
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        if self.rate_limiter is not None:
+                            await self.rate_limiter.consume_async(len(chunk))
+                        await on_chunk(offset, chunk)
+                        offset += len(chunk)
+                        if end is not None and offset > end:
+                            break
+                    return offset
+            raise PermissionError(f"认证失败: {digest[:12]}")
+
+class _RangeIgnored(Exception):
+    pass
+
+async def _async_retry(layer_digest, fetch_from, get_position, telemetry=_NO_TELEMETRY):
+    aiohttp = optional_module("aiohttp")
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await fetch_from(get_position())
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            telemetry.retry(layer_digest)
+            logger.warning(f"下载中断 {layer_digest[:12]}（{str(e)}），从 {get_position()} 字节处继续")
+            await asyncio.sleep(RETRY_DELAY * (RETRY_BACKOFF ** attempt))
+
+async def _download_layer_async(fetcher, layer, output_dir, layer_index, segment_size, cache,
+                                decompress, pipeline):
+    layer_digest = layer['digest']
+    blob_size = layer.get('size', 0)
+    telemetry = fetcher.telemetry
+    completed = await asyncio.to_thread(_completed_layer_path, layer, output_dir, layer_index, decompress)
+    if completed:
+        telemetry.skip(layer_digest, blob_size, 'local')
+        return completed
+    stream, tar_path = await asyncio.to_thread(
+        _open_layer_stream, layer_digest, output_dir, decompress, pipeline, layer_compression(layer)
+    )
+    try:
+        resuming = stream.resume_journal is not None
+        if cache is not None and stream.offset == 0 and not resuming \
+                and await asyncio.to_thread(_extract_cached_blob, stream, cache):
+            telemetry.skip(layer_digest, blob_size, 'cache')
+            return await asyncio.to_thread(
+                _finish_layer_stream, stream, tar_path, layer_index, cache, True
+            )
+
+        telemetry.start(layer_digest, blob_size, _resumed_bytes(stream))
+        with profiler.span("download.network", blob_size - _resumed_bytes(stream)):
+            if resuming or (stream.offset == 0 and blob_size >= segment_size * 2):
+                segmented = await _download_segmented_async(fetcher, layer_digest, blob_size, stream, segment_size)
+            else:
+                segmented = False
+
+            if not segmented:
+                async def on_chunk(offset, chunk):
+                    if offset != stream.offset:
+                        logger.warning(f"服务器不支持断点续传，重新下载 {layer_digest[:12]}")
+                        await asyncio.to_thread(stream.reset)
+                    await asyncio.to_thread(stream.update, chunk)
+                    telemetry.advance(layer_digest, len(chunk))
+
+                await _async_retry(
+                    layer_digest,
+                    lambda pos: fetcher.fetch(layer_digest, pos, None, on_chunk),
+                    lambda: stream.offset,
+                    telemetry
+                )
+        layer_file = await asyncio.to_thread(_finish_layer_stream, stream, tar_path, layer_index, cache)
+        telemetry.finish(layer_digest, stream.decompress_time)
+        return layer_file
+    except BaseException as e:
+        telemetry.fail(layer_digest, e)
+        _discard_layer_stream(stream)
+        raise
+
+async def _download_segmented_async(fetcher, layer_digest, blob_size, stream, segment_size):
+    telemetry = fetcher.telemetry
+    if stream.resume_journal is not None:
+        journal = await asyncio.to_thread(_resume_segments, stream)
+        fd = os.open(stream.gz_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    else:
+        fd, journal = await asyncio.to_thread(_allocate_segments, stream, blob_size, segment_size)
+    segments = journal.segments()
+    lock = threading.Lock()
+    range_ignored = []
+
+    async def fetch_segment(start, end):
+        position = [start]
+
+        async def on_chunk(offset, chunk):
+            if offset != position[0]:
+                range_ignored.append(start)
+                raise _RangeIgnored()
+            chunk = chunk[:end + 1 - offset]
+            written = 0
+            while written < len(chunk):
+                written += _pwrite(fd, chunk[written:], offset + written, lock)
+            position[0] += len(chunk)
+            telemetry.advance(layer_digest, len(chunk))
+
+        while position[0] <= end:
+            await _async_retry(
+                layer_digest,
+                lambda pos: fetcher.fetch(layer_digest, pos, end, on_chunk),
+                lambda: position[0],
+                telemetry
+            )
+        await asyncio.to_thread(journal.mark, start, end)
+
+    try:
+        tasks = [
+            None if (start, end) in journal.done else asyncio.ensure_future(fetch_segment(start, end))
+            for start, end in segments
+        ]
+        pending = [task for task in tasks if task is not None]
+        try:
+            with open(stream.gz_path, 'rb', buffering=0) as reader:
+                for task, (start, end) in zip(tasks, segments):
+                    if task is not None:
+                        await task
+                    await asyncio.to_thread(_process_segment, reader, stream, start, end)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if range_ignored:
+                logger.info(f"服务器不支持分段下载，改为单连接下载 {layer_digest[:12]}")
+                journal.remove()
+                stream.reset()
+                return False
+            raise
+        return True
+    finally:
+        _close_segments(fd, stream, journal, blob_size)
+
+async def _download_layer_jobs_async(registry, jobs, output_dir, layer_index,
+                                     concurrency, segment_size, cache, decompress, token_manager,
+                                     rate_limiter, schedule, pipeline, telemetry, verify):
+    aiohttp = optional_module("aiohttp")
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout, trust_env=True, auto_decompress=False
+    ) as http:
+        fetchers = {}
+        semaphores = {}
+        for repo, img, _ in jobs:
+            if (repo, img) not in fetchers:
+                fetchers[(repo, img)] = AsyncBlobFetcher(
+                    http, registry, repo, img, concurrency, semaphores, token_manager, rate_limiter,
+                    telemetry, verify
+                )
+        if telemetry is not None:
+            telemetry.expect(sum(layer.get('size', 0) for _, _, layer in jobs))
+        # 信号量按先来先得放行，协程创建顺序即调度顺序
+        order = schedule_jobs(jobs, output_dir, schedule)
+        tasks = [
+            asyncio.ensure_future(_download_layer_async(
+                fetchers[(jobs[idx][0], jobs[idx][1])], jobs[idx][2], output_dir, layer_index,
+                segment_size, cache, decompress and is_layer_descriptor(jobs[idx][2]), pipeline
+            ))
+            for idx in order
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # 某一层失败或被中断时立即取消其余仍在下载的层，已写入的部分保留供续传
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        layer_files = [None] * len(jobs)
+        for idx, result in zip(order, results):
+            layer_files[idx] = result
+        return layer_files
+
+def download_layer_jobs_async(registry, jobs, output_dir, layer_index=None,
+                              concurrency=ASYNC_CONCURRENCY, segment_size=SEGMENT_SIZE, cache=None,
+                              decompress=True, token_manager=None, rate_limiter=None,
+                              schedule="largest", decompress_workers=None, telemetry=None, verify=True):
+    if optional_module("aiohttp") is None:
+        raise RuntimeError("异步下载引擎需要安装 aiohttp: pip install aiohttp")
+    pipeline = DecompressPipeline(decompress_workers) if decompress and decompress_workers != 0 else None
+    try:
+        return asyncio.run(_download_layer_jobs_async(
+            registry, jobs, output_dir, layer_index, concurrency, segment_size, cache, decompress,
+            token_manager, rate_limiter, schedule, pipeline, telemetry, verify
+        ))
+    finally:
+        if pipeline is not None:
+            pipeline.shutdown()
+            logger.info(pipeline.report())
+
+def build_image(output_path, layers_dir, repo, img, tag, package_format="synology", layer_digests=None,
+                manifest_raw=None, config_digest=None):
+    image = {
+        'repo': repo,
+        'img': img,
+        'tag': tag,
+        'layer_digests': layer_digests,
+        'manifest_raw': manifest_raw,
+        'config_digest': config_digest
+    }
+    _build_archive(output_path, layers_dir, [image], package_format)
+    if package_format == "synology":
+        logger.info(f"群晖兼容镜像已生成: {output_path}")
+    elif package_format == "oci":
+        logger.info(f"OCI镜像布局已生成: {output_path}")
+    elif package_format == "docker-gz":
+        logger.info(f"压缩层Docker镜像已生成: {output_path}")
+    else:
+        logger.info(f"标准Docker镜像已生成: {output_path}")
+
+def build_bundle(output_path, layers_dir, images, package_format="synology"):
+    # 多个镜像写入同一归档（类似 docker save 多个镜像），相同的层只存一份
+    _build_archive(output_path, layers_dir, images, package_format)
+    logger.info(f"多镜像合集已生成: {output_path}（{len(images)} 个镜像）")
+
+def _build_archive(output_path, layers_dir, images, package_format):
+    if package_format in COMPRESSED_FORMATS:
+        _write_layout_archive(output_path, layers_dir, images, with_docker_manifest=package_format == "docker-gz")
+        return
+
+    layer_index = LayerIndex(layers_dir)
+    entries = []
+    for image in images:
+        layers = layer_index.entries(image.get('layer_digests'))
+        if image.get('config_digest'):
+            config_bytes = _read_config_blob(layers_dir, image['config_digest'], layers)
+        else:
+            # 没有原始配置时（如旧版工作目录）按解压结果生成
+            if package_format == "synology":
+                config_content = _synology_config(layers)
+            else:
+                config_content = _docker_config(layers)
+            config_bytes = json.dumps(config_content, indent=2).encode()
+        entries.append(dict(image, layers=layers, config_bytes=config_bytes))
+    _write_image_archive(output_path, entries, with_repositories=package_format == "synology")
+
+# 直接向输出文件写入 tar 条目，层文件尽量通过 copy_file_range/sendfile 在内核中拷贝
+class TarStreamWriter:
+    def __init__(self, output_path):
+        self.file = open(output_path, 'wb', buffering=0)
+        self.mtime = int(time.time())
+        self.offset = 0
+        self.copy_method = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add_dir(self, name):
+        info = tarfile.TarInfo(name.rstrip('/') + '/')
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = self.mtime
+        self._write(info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape'))
+
+    def add_bytes(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = self.mtime
+        self._write(info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape'))
+        self._write(data)
+        self._pad(len(data))
+
+    def add_file(self, name, path):
+        size = os.path.getsize(path)
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = self.mtime
+        self._write(info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape'))
+        with profiler.span("build.copy", size), open(path, 'rb') as src:
+            self._copy(src, size)
+        self._pad(size)
+
+    def close(self):
+        if self.file.closed:
+            return
+        # 两个空块作为归档结束标记，并补齐到记录大小
+        end = tarfile.BLOCKSIZE * 2
+        remainder = (self.offset + end) % tarfile.RECORDSIZE
+        if remainder:
+            end += tarfile.RECORDSIZE - remainder
+        self._write(b'\0' * end)
+        self.file.close()
+
+    def _copy(self, src, size):
+        src_fd, dst_fd = src.fileno(), self.file.fileno()
+        copied = 0
+        if self.copy_method in (None, 'copy_file_range') and hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                self.copy_method = 'copy_file_range'
+            except OSError:
+                pass
+        if copied < size and self.copy_method in (None, 'sendfile') and hasattr(os, 'sendfile'):
+            try:
+                while copied < size:
+                    n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                self.copy_method = 'sendfile'
+            except OSError:
+                pass
+        if copied < size:
+            self.copy_method = 'copyfileobj'
+            src.seek(copied)
+            while copied < size:
+                chunk = src.read(min(CHUNK_SIZE, size - copied))
+                if not chunk:
+                    break
+                self.file.write(chunk)
+                copied += len(chunk)
+        if copied != size:
+            raise IOError(f"层文件读取不完整: {src.name}")
+        # 内核拷贝会移动文件指针，统一同步到写入后的位置
+        self.offset += size
+        self.file.seek(self.offset)
+
+    def _pad(self, size):
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self._write(b'\0' * (tarfile.BLOCKSIZE - remainder))
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            n = self.file.write(view)
+            view = view[n:]
+            self.offset += n
+
+def _write_image_archive(output_path, images, with_repositories):
+    tmp_path = f"{output_path}.tmp"
+    try:
+        with TarStreamWriter(tmp_path) as tar:
+            written = set()
+            manifest = []
+            repositories = {}
+            for image in images:
+                config_bytes = image['config_bytes']
+                config_hash = hashlib.sha256(config_bytes).hexdigest()
+                layer_ids = [entry['diff_id'].split(':', 1)[1] for entry in image['layers']]
+
+                for layer_id, entry in zip(layer_ids, image['layers']):
+                    if layer_id not in written:
+                        tar.add_dir(layer_id)
+                        tar.add_file(f"{layer_id}/layer.tar", entry['path'])
+                        written.add(layer_id)
+
+                if config_hash not in written:
+                    tar.add_bytes(f"{config_hash}.json", config_bytes)
+                    written.add(config_hash)
+
+                repo, img, tag = image['repo'], image['img'], image['tag']
+                manifest.append({
+                    "Config": f"{config_hash}.json",
+                    "RepoTags": [f"{repo}/{img}:{tag}"],
+                    "Layers": [f"{layer_id}/layer.tar" for layer_id in layer_ids]
+                })
+                # 生成repositories（关键修正）
+                repositories.setdefault(f"{repo}/{img}", {})[tag] = layer_ids[-1]
+
+            tar.add_bytes("manifest.json", json.dumps(manifest, indent=2).encode())
+            if with_repositories:
+                tar.add_bytes("repositories", json.dumps(repositories, indent=2).encode())
+            logger.debug(f"层文件拷贝方式: {tar.copy_method}")
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _write_layout_archive(output_path, layers_dir, images, with_docker_manifest):
+    # 压缩层原样放入 blobs/<算法>/<摘要>，清单与配置保持仓库中的原始字节，无需解压
+    tmp_path = f"{output_path}.tmp"
+    try:
+        with TarStreamWriter(tmp_path) as tar:
+            written = set()
+            index_manifests = []
+            docker_manifest = []
+
+            def add_blob(digest, data=None):
+                alg, digest_hex = digest.split(':', 1)
+                if f"blobs/{alg}" not in written:
+                    if not written:
+                        tar.add_dir("blobs")
+                    tar.add_dir(f"blobs/{alg}")
+                    written.add(f"blobs/{alg}")
+                name = f"blobs/{alg}/{digest_hex}"
+                if name not in written:
+                    if data is None:
+                        tar.add_file(name, blob_path(layers_dir, digest))
+                    else:
+                        tar.add_bytes(name, data)
+                    written.add(name)
+                return name
+
+            for image in images:
+                raw = image['manifest_raw']
+                manifest = json.loads(raw)
+                config_name = add_blob(manifest['config']['digest'])
+                layer_names = [add_blob(layer['digest']) for layer in manifest['layers']]
+                manifest_digest = f"sha256:{hashlib.sha256(raw).hexdigest()}"
+                add_blob(manifest_digest, raw)
+
+                repo, img, tag = image['repo'], image['img'], image['tag']
+                descriptor = {
+                    "mediaType": manifest.get('mediaType', "application/vnd.oci.image.manifest.v1+json"),
+                    "digest": manifest_digest,
+                    "size": len(raw),
+                    "annotations": {
+                        "io.containerd.image.name": f"{repo}/{img}:{tag}",
+                        "org.opencontainers.image.ref.name": tag
+                    }
+                }
+                if image.get('platform'):
+                    descriptor["platform"] = image['platform']
+                index_manifests.append(descriptor)
+                docker_manifest.append({
+                    "Config": config_name,
+                    "RepoTags": [f"{repo}/{img}:{tag}"],
+                    "Layers": layer_names
+                })
+
+            tar.add_bytes("oci-layout", json.dumps({"imageLayoutVersion": "1.0.0"}).encode())
+            index = {
+                "schemaVersion": 2,
+                "mediaType": "application/vnd.oci.image.index.v1+json",
+                "manifests": index_manifests
+            }
+            tar.add_bytes("index.json", json.dumps(index, indent=2).encode())
+            if with_docker_manifest:
+                tar.add_bytes("manifest.json", json.dumps(docker_manifest, indent=2).encode())
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _read_config_blob(layers_dir, config_digest, layers):
+    # 原样使用仓库中的配置，rootfs.diff_ids 决定层目录名，须与解压时记录的一致
+    with open(blob_path(layers_dir, config_digest), 'rb') as f:
+        config_bytes = f.read()
+    diff_ids = json.loads(config_bytes).get('rootfs', {}).get('diff_ids', [])
+    if diff_ids != [entry['diff_id'] for entry in layers]:
+        raise ValueError(f"镜像层 diff_id 与配置不符: {config_digest[:19]}")
+    return config_bytes
+
+def _synology_config(layers):
+    # 生成config.json
+    return {
+        "architecture": "amd64",
+        "os": "linux",
+        "history": [{
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "created_by": f"docker_pull {VERSION}"
+        }],
+        "rootfs": {
+            "type": "layers",
+            "diff_ids": [entry['diff_id'] for entry in layers]
+        }
+    }
+
+def _docker_config(layers):
+    return {
+        "architecture": "amd64",
+        "os": "linux",
+        "rootfs": {
+            "type": "layers",
+            "diff_ids": [entry['diff_id'] for entry in layers]
+        }
+    }
+
+def resolve_image(session, registry, image, arch, manifest_cache=None):
+    return resolve_image_platforms(session, registry, image, arch, manifest_cache)[0]
+
+def resolve_image_platforms(session, registry, image, arch, manifest_cache=None):
+    # 索引只请求一次，各平台清单并发获取；请求多个平台时结果带 platform 字段用于区分输出
+    repo, img, tag = parse_image_input(image)
+    targets = parse_platforms(arch)
+    multi = targets is None or len(targets) > 1
+    auth_headers = get_auth_token(session, registry, repo, img)
+    manifest, raw, media_type = fetch_manifest(
+        session, registry, repo, img, tag, auth_headers, manifest_cache
+    )
+
+    def describe(manifest, raw, media_type, platform=None):
+        return {
+            'image': image,
+            'repo': repo,
+            'img': img,
+            'tag': tag,
+            'platform': platform,
+            'manifest': manifest,
+            'manifest_raw': raw,
+            'media_type': media_type,
+            'digest': f"sha256:{hashlib.sha256(raw).hexdigest()}"
+        }
+
+    if 'manifests' not in manifest:
+        return [describe(manifest, raw, media_type)]
+
+    selected = _select_platforms(manifest, targets)
+    with ThreadPoolExecutor(max_workers=len(selected)) as executor:
+        futures = [
+            executor.submit(
+                fetch_manifest, session, registry, repo, img, m['digest'], auth_headers, manifest_cache
+            )
+            for m in selected
+        ]
+        return [
+            describe(*future.result(), platform=m['platform'] if multi else None)
+            for m, future in zip(selected, futures)
+        ]
+
+def read_image_list(path):
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    images = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if line and line not in images:
+            images.append(line)
+    return images
+
+def read_sync_state(output_path):
+    state_path = f"{output_path}{SYNC_STATE_SUFFIX}"
+    if not os.path.exists(output_path) or not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_sync_state(output_path, package_format, images, layer_index):
+    # 记录生成归档所用的清单摘要，以及每个层/配置在归档中的位置，供 --sync 比较与复用
+    compressed = package_format in COMPRESSED_FORMATS
+    blobs = {}
+    for image in images:
+        config_digest = image['manifest']['config']['digest']
+        if compressed:
+            blobs[config_digest] = {'member': f"blobs/{config_digest.replace(':', '/', 1)}"}
+        else:
+            blobs[config_digest] = {'member': f"{config_digest.split(':', 1)[1]}.json"}
+        for layer in image['manifest']['layers']:
+            digest = layer['digest']
+            if compressed:
+                blobs[digest] = {'member': f"blobs/{digest.replace(':', '/', 1)}"}
+            else:
+                diff_id = layer_index.layers[digest]['diff_id']
+                blobs[digest] = {'member': f"{diff_id.split(':', 1)[1]}/layer.tar", 'diff_id': diff_id}
+    state = {
+        'format': package_format,
+        'images': [{'image': image['image'], 'digest': image['digest']} for image in images],
+        'blobs': blobs,
+        'updated': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+    state_path = f"{output_path}{SYNC_STATE_SUFFIX}"
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+def is_sync_current(state, package_format, images):
+    return bool(state) and state.get('format') == package_format and state.get('images') == [
+        {'image': image['image'], 'digest': image['digest']} for image in images
+    ]
+
+def restore_from_archive(archive_path, state, digests, work_dir, layer_index):
+    # 从上次生成的归档中取回未变化的层与配置，边复制边校验摘要（解压格式校验 diff_id）
+    restored = set()
+    wanted = [digest for digest in digests if digest in state.get('blobs', {})]
+    if not wanted:
+        return restored
+    with tarfile.open(archive_path, 'r:') as tar:
+        for digest in wanted:
+            entry = state['blobs'][digest]
+            try:
+                src = tar.extractfile(entry['member'])
+            except KeyError:
+                src = None
+            if src is None:
+                continue
+            diff_id = entry.get('diff_id')
+            if diff_id:
+                dest = os.path.join(work_dir, f"{digest.replace(':', '_').replace('/', '_')}.tar")
+            else:
+                dest = blob_path(work_dir, digest)
+            expected = diff_id or digest
+            hasher = hashlib.new(expected.split(':', 1)[0])
+            size = 0
+            with src, open(f"{dest}.download", 'wb') as f:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if hasher.hexdigest() != expected.split(':', 1)[1]:
+                os.remove(f"{dest}.download")
+                logger.warning(f"归档中的层校验失败，将重新下载: {digest[:19]}")
+                continue
+            os.replace(f"{dest}.download", dest)
+            if diff_id:
+                layer_index.record(digest, dest, diff_id, size)
+            restored.add(digest)
+    return restored
+
+def _image_file_name(image, platform=True, package_format=None):
+    repo, img, tag = image['repo'], image['img'], image['tag']
+    suffix = f"_{platform_name(image['platform'])}" if platform and image.get('platform') else ""
+    if package_format:
+        suffix += f"_{package_format}"
+    return f"{repo.replace('/', '_')}_{img}_{tag}{suffix}.tar"
+
+def _bundle_entry(image, compressed):
+    return {
+        'repo': image['repo'],
+        'img': image['img'],
+        # docker-save 格式按 RepoTags 区分镜像，多平台时标签加上平台后缀
+        'tag': image['tag'] if compressed or not image.get('platform')
+        else f"{image['tag']}-{platform_name(image['platform'])}",
+        'platform': image.get('platform'),
+        'layer_digests': [layer['digest'] for layer in image['manifest']['layers']],
+        'manifest_raw': image['manifest_raw'],
+        'config_digest': image['manifest']['config']['digest']
+    }
+
+# 库接口：在长期运行的进程中嵌入使用，多次拉取共享同一会话（连接池）、令牌、清单缓存与镜像层缓存。
+# resolve / fetch / build 可分别调用，pull 依次完成三步；同一实例可在多个线程中并发使用
+class Puller:
+    def __init__(self, registry="registry-1.docker.io", work_dir=None, workers=MAX_WORKERS,
+                 segment_size=SEGMENT_SIZE, segment_workers=SEGMENT_WORKERS, cache_dir=None,
+                 cache_size=CACHE_MAX_SIZE, manifest_cache_dir=None, token_cache=None, transport="http1",
+                 limit_rate=0, verify=True, schedule="largest", decompress_workers=None, telemetry=None,
+                 pool_size=None):
+        if segment_size <= 0:
+            raise ValueError(f"分段大小必须大于 0: {segment_size}")
+        self.registry = registry
+        # pull 在 work_dir 下为每次拉取创建临时目录（默认使用系统临时目录），完成后删除
+        self.work_dir = work_dir
+        self.workers = workers
+        self.segment_size = segment_size
+        self.segment_workers = segment_workers
+        self.schedule = schedule
+        self.decompress_workers = decompress_workers
+        # 多个拉取同时进行时由调用方按总并发数指定 pool_size
+        self.session = create_session(
+            token_cache, pool_size or pool_size_for(workers, segment_workers), transport
+        )
+        self.session.verify = verify
+        self.session.rate_limiter = RateLimiter(limit_rate) if limit_rate else None
+        self.session.telemetry = telemetry
+        self.cache = BlobCache(cache_dir, cache_size) if cache_dir else None
+        self.manifest_cache = ManifestCache(manifest_cache_dir) if manifest_cache_dir else None
+        # 每个输出目录只使用一个层索引实例，多线程向同一目录下载时记录不会丢失
+        self.layer_indexes = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def layer_index(self, layers_dir):
+        key = os.path.abspath(layers_dir)
+        with self.lock:
+            if key not in self.layer_indexes:
+                os.makedirs(key, exist_ok=True)
+                self.layer_indexes[key] = LayerIndex(key)
+            return self.layer_indexes[key]
+
+    def resolve(self, image, arch="amd64"):
+        # 返回清单解析结果列表，arch 可为逗号分隔的多个平台或 all
+        return resolve_image_platforms(self.session, self.registry, image, arch, self.manifest_cache)
+
+    def fetch_blob(self, image, descriptor, output_dir, decompress=False):
+        # 下载单个 blob（镜像层或配置）到 output_dir 并校验摘要，返回文件路径；
+        # decompress 为 True 时镜像层解压为 tar 并记录到 output_dir 的层索引
+        repo, img, _ = parse_image_input(image)
+        decompress = decompress and is_layer_descriptor(descriptor)
+        return download_layer(
+            self.session, self.registry, repo, img, descriptor, output_dir, None,
+            layer_index=self.layer_index(output_dir) if decompress else None,
+            segment_size=self.segment_size,
+            segment_workers=self.segment_workers,
+            cache=self.cache,
+            decompress=decompress
+        )
+
+    def fetch(self, images, layers_dir, package_format="synology"):
+        # 下载已解析镜像的全部镜像层与配置，多个镜像共有的层只下载一次
+        jobs = {}
+        for image in images:
+            manifest = image['manifest']
+            for blob in manifest['layers'] + [manifest['config']]:
+                jobs.setdefault(blob['digest'], (image['repo'], image['img'], blob))
+        layer_index = self.layer_index(layers_dir)
+        layer_index.set_order([
+            digest for digest, (_, _, blob) in jobs.items() if is_layer_descriptor(blob)
+        ])
+        download_layer_jobs(
+            self.session, self.registry, list(jobs.values()), layers_dir, layer_index,
+            workers=self.workers,
+            segment_size=self.segment_size,
+            segment_workers=self.segment_workers,
+            cache=self.cache,
+            decompress=package_format not in COMPRESSED_FORMATS,
+            schedule=self.schedule,
+            decompress_workers=self.decompress_workers
+        )
+        return layer_index
+
+    def build(self, images, layers_dir, output_path, package_format="synology"):
+        # 一个镜像时生成单镜像归档，多个（如多平台）时写入同一归档
+        if len(images) == 1:
+            image = images[0]
+            build_image(
+                output_path, layers_dir, image['repo'], image['img'], image['tag'], package_format,
+                layer_digests=[layer['digest'] for layer in image['manifest']['layers']],
+                manifest_raw=image['manifest_raw'],
+                config_digest=image['manifest']['config']['digest']
+            )
+        else:
+            compressed = package_format in COMPRESSED_FORMATS
+            build_bundle(output_path, layers_dir, [_bundle_entry(image, compressed) for image in images],
+                         package_format)
+        return output_path
+
+    def pull(self, image, output_path, arch="amd64", package_format="synology"):
+        images = self.resolve(image, arch)
+        import tempfile
+        layers_dir = tempfile.mkdtemp(prefix="docker_pull_", dir=self.work_dir)
+        try:
+            self.fetch(images, layers_dir, package_format)
+            return self.build(images, layers_dir, output_path, package_format)
+        finally:
+            with self.lock:
+                self.layer_indexes.pop(os.path.abspath(layers_dir), None)
+            shutil.rmtree(layers_dir, ignore_errors=True)
+
+def _is_within(path, directory):
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+# 常驻服务：通过本地 HTTP 或 unix 套接字接收拉取任务，所有任务共用一个 Puller（连接池、令牌、清单与镜像层缓存）。
+# 参数相同且尚未结束的任务合并为一个；不同任务需要的同一个层只下载一次，下载期间其余任务等待其结果
+class PullService:
+    def __init__(self, puller, output_dir, work_dir, jobs=SERVE_JOBS):
+        self.puller = puller
+        self.output_dir = os.path.abspath(output_dir)
+        self.work_dir = os.path.abspath(work_dir)
+        # 解压格式与保持压缩格式的层分目录存放，同一摘要在两种目录中互不干扰
+        self.layer_dirs = {
+            False: os.path.join(work_dir, "layers"),
+            True: os.path.join(work_dir, "blobs")
+        }
+        for path in self.layer_dirs.values():
+            os.makedirs(path, exist_ok=True)
+        self.layer_indexes = {compressed: LayerIndex(path) for compressed, path in self.layer_dirs.items()}
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.active = {}
+        self.claims = {}
+        self.started = time.time()
+        self.deduplicated = 0
+        self.shared_blobs = 0
+
+    def submit(self, request):
+        # 返回 (任务, 是否与进行中的任务合并)
+        image = request.get('image')
+        if not isinstance(image, str) or not image:
+            raise ValueError("缺少镜像名称 image")
+        package_format = request.get('format', "synology")
+        if package_format not in PACKAGE_FORMATS:
+            raise ValueError(f"不支持的打包格式: {package_format}")
+        arch = request.get('arch', "amd64")
+        if not isinstance(arch, str) or not arch.strip():
+            raise ValueError("架构 arch 必须是非空字符串")
+        parse_platforms(arch)
+        output = request.get('output')
+        if output is not None and (not isinstance(output, str) or not output):
+            raise ValueError("输出文件名 output 必须是非空字符串")
+        output_path = self._output_path(output) if output else None
+        key = (parse_image_input(image), arch, package_format, output_path)
+        with self.lock:
+            job = self.active.get(key)
+            if job is not None:
+                self.deduplicated += 1
+                logger.info(f"[{job.id}] 合并相同的拉取请求: {image}")
+                return job, True
+            job = PullJob(image, arch, package_format, output_path)
+            job.key = key
+            self.jobs[job.id] = job
+            self.active[key] = job
+            self._trim_history()
+        logger.info(f"[{job.id}] 已接收: {image}（{arch}，{package_format}）")
+        self.executor.submit(self._run, job)
+        return job, False
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def describe(self, job):
+        return job.describe(self._telemetry().snapshot())
+
+    def describe_jobs(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        snapshot = self._telemetry().snapshot()
+        return [job.describe(snapshot) for job in jobs]
+
+    def status(self):
+        snapshot = self._telemetry().snapshot()
+        with self.lock:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            blobs_in_flight = len(self.claims)
+        status = {
+            'version': VERSION,
+            'uptime': round(time.time() - self.started, 3),
+            'jobs': states,
+            'jobs_deduplicated': self.deduplicated,
+            'blobs_in_flight': blobs_in_flight,
+            'blobs_shared': self.shared_blobs,
+            'transfer': _summary(snapshot),
+            'connections': connection_report(self.puller.session)
+        }
+        if self.puller.cache is not None:
+            status['cache'] = self.puller.cache.report()
+        if self.puller.manifest_cache is not None:
+            status['manifest_cache'] = self.puller.manifest_cache.report()
+        return status
+
+    def metrics(self):
+        snapshot = self._telemetry().snapshot()
+        with self.lock:
+            states = {state: 0 for state in JOB_STATES}
+            for job in self.jobs.values():
+                states[job.state] += 1
+            lines = ["# TYPE docker_pull_jobs gauge"]
+            lines += [f'docker_pull_jobs{{state="{state}"}} {count}' for state, count in states.items()]
+            lines += [
+                "# TYPE docker_pull_jobs_deduplicated_total counter",
+                f"docker_pull_jobs_deduplicated_total {self.deduplicated}",
+                "# TYPE docker_pull_blobs_shared_total counter",
+                f"docker_pull_blobs_shared_total {self.shared_blobs}",
+                "# TYPE docker_pull_blobs_in_flight gauge",
+                f"docker_pull_blobs_in_flight {len(self.claims)}",
+            ]
+        return prometheus_text(snapshot) + '\n'.join(lines) + '\n'
+
+    def close(self):
+        with self.lock:
+            running = sum(1 for job in self.jobs.values() if job.state not in ("done", "failed"))
+        if running:
+            logger.info(f"等待 {running} 个未完成的任务结束（排队中的任务将被取消）")
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _run(self, job):
+        compressed = job.format in COMPRESSED_FORMATS
+        claimed = []
+        try:
+            job.set_state("resolving")
+            images = self.puller.resolve(job.image, job.arch)
+            blobs = {}
+            for image in images:
+                manifest = image['manifest']
+                for blob in manifest['layers'] + [manifest['config']]:
+                    blobs.setdefault(blob['digest'], (image['repo'], image['img'], blob))
+            job.digests = list(blobs)
+            job.size = sum(blob.get('size', 0) for _, _, blob in blobs.values())
+
+            job.set_state("downloading")
+            downloads, waits, cached = [], [], []
+            with self.lock:
+                for digest, download in blobs.items():
+                    claim = self.claims.get((compressed, digest))
+                    if claim is None:
+                        claim = {'future': Future(), 'refs': 0}
+                        self.claims[(compressed, digest)] = claim
+                        downloads.append((download, claim))
+                        # 另一种格式的任务正在下载同一层时，启用缓存则等它写入缓存后直接取用
+                        other = self.claims.get((not compressed, digest))
+                        if other is not None and self.puller.cache is not None:
+                            cached.append(other['future'])
+                    else:
+                        waits.append(claim)
+                        self.shared_blobs += 1
+                    claim['refs'] += 1
+                    claimed.append((digest, claim))
+            if waits:
+                logger.info(f"[{job.id}] {len(waits)} 个层/配置由其他任务下载，等待共享")
+            for future in cached:
+                # 只等待其结束，对方失败时由本任务自行下载
+                future.exception()
+            self._download(compressed, downloads)
+            for claim in waits:
+                claim['future'].result()
+
+            job.set_state("building")
+            # 默认文件名带上打包格式，同一镜像的不同格式任务不会写到同一个文件
+            output_path = job.output_path or os.path.join(
+                self.output_dir, _image_file_name(images[0], platform=len(images) == 1, package_format=job.format)
+            )
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            # 先写临时文件再替换，同一输出路径的任务并发打包时不会互相覆盖到一半
+            tmp_path = f"{output_path}.{job.id}.tmp"
+            try:
+                self.puller.build(images, self.layer_dirs[compressed], tmp_path, job.format)
+                os.replace(tmp_path, output_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            job.output_path = output_path
+            job.set_state("done")
+            logger.info(f"[{job.id}] 完成: {output_path}（{job.elapsed():.2f} 秒）")
+        except Exception as e:
+            job.error = str(e)
+            job.set_state("failed")
+            logger.error(f"[{job.id}] 拉取失败 {job.image}: {str(e)}")
+        finally:
+            self._release(compressed, claimed)
+            with self.lock:
+                if self.active.get(job.key) is job:
+                    del self.active[job.key]
+            job.done.set()
+
+    def _download(self, compressed, downloads):
+        if not downloads:
+            return
+        layer_index = self.layer_indexes[compressed]
+        try:
+            download_layer_jobs(
+                self.puller.session, self.puller.registry, [download for download, _ in downloads],
+                self.layer_dirs[compressed], layer_index,
+                workers=self.puller.workers,
+                segment_size=self.puller.segment_size,
+                segment_workers=self.puller.segment_workers,
+                cache=self.puller.cache,
+                decompress=not compressed,
+                schedule=self.puller.schedule,
+                decompress_workers=self.puller.decompress_workers
+            )
+        except BaseException as e:
+            # 等待同一批层的其他任务一并失败；认领记录移除后，后续任务会重新下载（已下载部分可续传）
+            with self.lock:
+                for (_, _, blob), claim in downloads:
+                    if self.claims.get((compressed, blob['digest'])) is claim:
+                        del self.claims[(compressed, blob['digest'])]
+            for _, claim in downloads:
+                if not claim['future'].done():
+                    claim['future'].set_exception(e)
+            raise
+        for _, claim in downloads:
+            claim['future'].set_result(None)
+
+    def _release(self, compressed, claimed):
+        # 没有任务再引用的层从共享目录删除，之后的任务从镜像层缓存或仓库重新获取
+        layers_dir = self.layer_dirs[compressed]
+        layer_index = self.layer_indexes[compressed]
+        released = []
+        with self.lock:
+            for digest, claim in claimed:
+                claim['refs'] -= 1
+                if claim['refs'] or self.claims.get((compressed, digest)) is not claim:
+                    continue
+                del self.claims[(compressed, digest)]
+                released.append(digest)
+            for digest in released:
+                entry = layer_index.forget(digest)
+                paths = [blob_path(layers_dir, digest)]
+                if entry is not None:
+                    paths.append(os.path.join(layers_dir, entry['file']))
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._telemetry().discard([
+                digest for digest in released
+                if (not compressed, digest) not in self.claims
+            ])
+
+    def _output_path(self, output):
+        # 输出文件限定在服务的输出目录内，且不能覆盖工作目录与缓存目录中的层、索引等共享文件
+        path = os.path.realpath(os.path.join(self.output_dir, output))
+        if not _is_within(path, self.output_dir):
+            raise ValueError(f"输出路径必须位于输出目录内: {output}")
+        reserved = [self.work_dir] + [
+            cache.cache_dir for cache in (self.puller.cache, self.puller.manifest_cache) if cache is not None
+        ]
+        if any(_is_within(path, directory) for directory in reserved):
+            raise ValueError(f"输出路径不能位于工作目录或缓存目录内: {output}")
+        return path
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done.is_set()]
+        for job_id in finished[:max(len(self.jobs) - JOB_HISTORY, 0)]:
+            del self.jobs[job_id]
+
+    def _telemetry(self):
+        return _telemetry(self.puller.session)
+
+class PullJob:
+    def __init__(self, image, arch, package_format, output_path):
+        import uuid
+        self.id = uuid.uuid4().hex[:12]
+        self.image = image
+        self.arch = arch
+        self.format = package_format
+        self.output_path = output_path
+        self.key = None
+        self.state = "queued"
+        self.error = None
+        self.digests = []
+        self.size = 0
+        self.created = time.time()
+        self.times = {}
+        self.done = threading.Event()
+
+    def set_state(self, state):
+        self.state = state
+        self.times[state] = time.time()
+
+    def elapsed(self):
+        started = self.times.get("resolving")
+        if started is None:
+            return 0.0
+        return (self.times.get("done") or self.times.get("failed") or time.time()) - started
+
+    def describe(self, snapshot=None):
+        blobs = snapshot['blobs'] if snapshot else {}
+        if self.state == "done":
+            completed = self.size
+        else:
+            completed = sum(blobs.get(digest, {}).get('bytes', 0) for digest in self.digests)
+        return {
+            'id': self.id,
+            'image': self.image,
+            'arch': self.arch,
+            'format': self.format,
+            'state': self.state,
+            'output': self.output_path,
+            'error': self.error,
+            'blobs': len(self.digests),
+            'size': self.size,
+            'completed': completed,
+            'created': round(self.created, 3),
+            'times': {state: round(t, 3) for state, t in self.times.items()},
+            'elapsed': round(self.elapsed(), 3)
+        }
+
+def _unlink_socket(path):
+    # 只删除套接字文件，返回是否已删除
+    import stat
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return False
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+def create_server(address, service):
+    # 服务端相关模块只在守护进程模式下导入
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class PullRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        server_version = f"docker-pull/{VERSION}"
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            service = self.server.service
+            if url.path == "/status":
+                return self._send_json(200, service.status())
+            if url.path == "/metrics":
+                return self._send(200, service.metrics().encode(), "text/plain; version=0.0.4")
+            if url.path == "/jobs":
+                return self._send_json(200, {'jobs': service.describe_jobs()})
+            if url.path.startswith("/jobs/"):
+                job = service.get(url.path[len("/jobs/"):])
+                if job is None:
+                    return self._send_json(404, {'error': "任务不存在"})
+                # ?wait=秒数 时阻塞到任务结束或超时
+                wait = parse_qs(url.query).get('wait')
+                if wait:
+                    try:
+                        job.done.wait(min(float(wait[0]), SERVE_MAX_WAIT))
+                    except ValueError:
+                        return self._send_json(400, {'error': f"无效的等待时间: {wait[0]}"})
+                return self._send_json(200, service.describe(job))
+            self._send_json(404, {'error': "未知路径"})
+
+        def do_POST(self):
+            if urlsplit(self.path).path != "/jobs":
+                return self._send_json(404, {'error': "未知路径"})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                if not isinstance(request, dict):
+                    raise ValueError("请求体必须是 JSON 对象")
+                job, deduplicated = self.server.service.submit(request)
+            except ValueError as e:
+                return self._send_json(400, {'error': str(e)})
+            self._send_json(200 if deduplicated else 202, dict(job.describe(), deduplicated=deduplicated))
+
+        def _send_json(self, status, data):
+            self._send(status, json.dumps(data, ensure_ascii=False, indent=2).encode(), "application/json")
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # unix 套接字没有客户端地址，访问日志只记录请求行
+            logger.debug(f"{self.requestline} -> {args[1] if len(args) > 1 else ''}")
+
+    # address 为 unix:/path/to/socket 或 主机:端口（默认只监听本机）
+    if address.startswith("unix:"):
+        import socket
+        # socketserver 只在支持 AF_UNIX 的平台上定义 UnixStreamServer（Windows 上没有）
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("当前平台不支持 unix 套接字，请使用 主机:端口")
+
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        path = address[len("unix:"):]
+        # 上次运行遗留的套接字文件需要先删除，其余同名文件不删除
+        if os.path.lexists(path) and not _unlink_socket(path):
+            raise ValueError(f"{path} 已存在且不是套接字")
+        server = UnixHTTPServer(path, PullRequestHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), PullRequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
@@ -0,0 +1,61 @@
+# 测试共用的模拟镜像仓库：在本进程内以 HTTPS 启动 benchmark.FakeRegistry（自签名证书，客户端不校验）
+import os
+import ssl
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import docker_pull
+from docker_pull import core
+
+IMAGE = "bench:latest"
+
+def pytest_configure(config):
+    config.addinivalue_line("filterwarnings", "ignore::urllib3.exceptions.InsecureRequestWarning")
+
+def registry_address(server):
+    return f"127.0.0.1:{server.server_address[1]}"
+
+def start_registry(cert, layers, layer_size, bandwidth=0, seed=0):
+    blobs, manifest = benchmark.synthetic_image(layers, layer_size, seed=seed)
+    server = benchmark.FakeRegistry(("127.0.0.1", 0), blobs, manifest, bandwidth=bandwidth)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*cert)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@pytest.fixture(scope="session")
+def cert(tmp_path_factory):
+    return benchmark.self_signed_cert(str(tmp_path_factory.mktemp("cert")))
+
+@pytest.fixture(scope="session")
+def registry(cert):
+    server = start_registry(cert, layers=6, layer_size=256 * 1024)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+# 限速仓库：每层约 2MB 压缩数据、总带宽 1MB/s，完整下载需要数秒，用于中断与取消
+@pytest.fixture(scope="session")
+def slow_registry(cert):
+    server = start_registry(cert, layers=2, layer_size=4 * 1024 * 1024, bandwidth=1024 * 1024)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def puller(registry, tmp_path):
+    with docker_pull.Puller(registry_address(registry), work_dir=str(tmp_path), verify=False) as puller:
+        yield puller
+
+@pytest.fixture
+def session():
+    session = core.create_session()
+    session.verify = False
+    yield session
+    session.close()
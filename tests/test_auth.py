@@ -0,0 +1,46 @@
+# 令牌缓存：保存的认证质询或令牌失效时重新探测，而不是每次运行都失败
+import json
+import os
+import time
+
+import pytest
+
+import docker_pull
+from docker_pull import core
+from conftest import IMAGE, registry_address
+
+def _stale_token_cache(path, registry, token=None):
+    # 旧的 realm 已不再签发令牌（模拟仓库对该路径返回 401）
+    repo, img, _ = core.parse_image_input(IMAGE)
+    tokens = {}
+    if token:
+        tokens[f"{registry}|repository:{repo}/{img}:pull"] = {'token': token, 'expires': time.time() + 3600}
+    path.write_text(json.dumps({
+        'challenges': {registry: {'realm': f"https://{registry}/stale-token", 'service': "stale-registry"}},
+        'tokens': tokens
+    }))
+    return str(path)
+
+@pytest.mark.parametrize("token", [None, "rejected-token"])
+def test_stale_challenge_is_reprobed(registry, tmp_path, token):
+    address = registry_address(registry)
+    token_cache = _stale_token_cache(tmp_path / "tokens.json", address, token)
+    with docker_pull.Puller(address, work_dir=str(tmp_path), verify=False, token_cache=token_cache) as puller:
+        puller.pull(IMAGE, str(tmp_path / "bench.tar"), package_format="docker")
+    with open(token_cache, 'r', encoding='utf-8') as f:
+        challenge = json.load(f)['challenges'][address]
+    assert challenge['realm'] == f"https://{address}/token"
+
+def test_stale_challenge_is_reprobed_async(registry, tmp_path):
+    pytest.importorskip("aiohttp")
+    address = registry_address(registry)
+    token_manager = core.TokenManager(_stale_token_cache(tmp_path / "tokens.json", address, "rejected-token"))
+    repo, img, _ = core.parse_image_input(IMAGE)
+    layers = json.loads(registry.manifest)['layers']
+    layers_dir = str(tmp_path / "layers")
+    os.makedirs(layers_dir)
+    core.download_layer_jobs_async(
+        address, [(repo, img, layer) for layer in layers], layers_dir, core.LayerIndex(layers_dir),
+        token_manager=token_manager, verify=False
+    )
+    assert token_manager.challenge(address)['service'] == "fake-registry"
@@ -0,0 +1,42 @@
+# 本地镜像层缓存：按最近最少使用淘汰，多次拉取之间共享
+import itertools
+
+import docker_pull
+from docker_pull import core
+from conftest import IMAGE, registry_address
+
+def _blob(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+def test_blob_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(core.time, "time", lambda: next(clock))
+    cache = core.BlobCache(str(tmp_path / "cache"), max_size=250)
+    cache.put("sha256:aa", _blob(tmp_path, "a", 100))
+    cache.put("sha256:bb", _blob(tmp_path, "b", 100))
+    assert cache.get("sha256:aa")
+    cache.put("sha256:cc", _blob(tmp_path, "c", 100))
+
+    assert cache.evicted == 1
+    assert cache.get("sha256:bb") is None
+    assert cache.get("sha256:aa") and cache.get("sha256:cc")
+    # 索引持久化，下次运行沿用
+    assert set(core.BlobCache(str(tmp_path / "cache"), max_size=250).entries) == {"sha256:aa", "sha256:cc"}
+
+def test_blob_cache_keeps_newest_entry_over_limit(tmp_path):
+    cache = core.BlobCache(str(tmp_path / "cache"), max_size=50)
+    cache.put("sha256:aa", _blob(tmp_path, "a", 100))
+    assert cache.get("sha256:aa")
+
+def test_second_pull_is_served_from_cache(registry, tmp_path):
+    address = registry_address(registry)
+    cache_dir = str(tmp_path / "cache")
+    for run in range(2):
+        with docker_pull.Puller(address, work_dir=str(tmp_path), verify=False, cache_dir=cache_dir,
+                                telemetry=core.Telemetry()) as puller:
+            puller.pull(IMAGE, str(tmp_path / f"bench{run}.tar"), package_format="docker")
+            downloaded = puller.session.telemetry.downloaded
+    assert puller.cache.hits == len(registry.blobs)
+    assert downloaded == 0
@@ -0,0 +1,44 @@
+# 中断与取消：停止事件置位或 Ctrl+C 后下载必须及时退出，且保留已下载部分供续传
+import json
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from docker_pull import core
+from conftest import IMAGE, registry_address
+
+def _slow_layers(server):
+    repo, img, _ = core.parse_image_input(IMAGE)
+    return [(repo, img, layer) for layer in json.loads(server.manifest)['layers']]
+
+def test_stop_event_cancels_layer_download(slow_registry, session, tmp_path):
+    repo, img, layer = _slow_layers(slow_registry)[0]
+    stop = threading.Event()
+    timer = threading.Timer(0.3, stop.set)
+    timer.start()
+    start = time.monotonic()
+    try:
+        with pytest.raises(core.DownloadCancelled):
+            core.download_layer(session, registry_address(slow_registry), repo, img, layer, str(tmp_path), None,
+                                decompress=False, stop=stop)
+    finally:
+        timer.cancel()
+    assert time.monotonic() - start < 2
+
+def test_interrupt_stops_layer_jobs(slow_registry, session, tmp_path):
+    layers_dir = str(tmp_path)
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT))
+    timer.start()
+    start = time.monotonic()
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            core.download_layer_jobs(session, registry_address(slow_registry), _slow_layers(slow_registry),
+                                     layers_dir, core.LayerIndex(layers_dir), workers=2, decompress_workers=1)
+    finally:
+        timer.cancel()
+    # 下载线程与解压线程池均已退出才会返回
+    assert time.monotonic() - start < 3
+    assert any(name.endswith(".download") for name in os.listdir(layers_dir))
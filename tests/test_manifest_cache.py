@@ -0,0 +1,47 @@
+# 清单缓存：标签以 If-None-Match 重新验证，未变化（304）时使用本地清单，变化后重新下载
+import hashlib
+
+import pytest
+
+import benchmark
+import docker_pull
+from conftest import IMAGE, registry_address, start_registry
+
+@pytest.fixture
+def own_registry(cert):
+    # 测试中会替换清单，不与其他测试共用
+    server = start_registry(cert, layers=2, layer_size=64 * 1024)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _resolve(server, tmp_path):
+    with docker_pull.Puller(registry_address(server), verify=False,
+                            manifest_cache_dir=str(tmp_path / "manifests")) as puller:
+        image = puller.resolve(IMAGE)[0]
+    return image, puller.manifest_cache
+
+def test_unchanged_tag_is_revalidated(own_registry, tmp_path):
+    first, _ = _resolve(own_registry, tmp_path)
+    second, cache = _resolve(own_registry, tmp_path)
+    assert second['digest'] == first['digest'] == own_registry.manifest_digest
+    assert (cache.revalidations, cache.misses) == (1, 0)
+
+def test_changed_tag_is_downloaded_again(own_registry, tmp_path):
+    _resolve(own_registry, tmp_path)
+    blobs, manifest = benchmark.synthetic_image(2, 64 * 1024, seed=1)
+    own_registry.blobs.update(blobs)
+    own_registry.manifest = manifest
+    own_registry.manifest_digest = f"sha256:{hashlib.sha256(manifest).hexdigest()}"
+
+    image, cache = _resolve(own_registry, tmp_path)
+    assert image['digest'] == own_registry.manifest_digest
+    assert (cache.revalidations, cache.misses) == (0, 1)
+
+def test_corrupt_cached_manifest_is_downloaded_again(own_registry, tmp_path):
+    first, cache = _resolve(own_registry, tmp_path)
+    with open(cache.path(first['digest']), 'wb') as f:
+        f.write(b'{}')
+    image, cache = _resolve(own_registry, tmp_path)
+    assert image['manifest_raw'] == own_registry.manifest
+    assert (cache.revalidations, cache.misses) == (0, 1)
@@ -0,0 +1,46 @@
+# 解压流水线：数据块在解压线程池中按顺序处理；线程池关闭后下载线程不能永久阻塞
+import gzip
+import hashlib
+import os
+import threading
+
+import pytest
+
+from docker_pull import core
+
+def _layer(tmp_path, size):
+    raw = os.urandom(size)
+    data = gzip.compress(raw)
+    digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    return raw, data, digest, str(tmp_path / "layer.gz"), str(tmp_path / "layer.tar")
+
+def test_pipeline_matches_inline_decompression(tmp_path):
+    raw, data, digest, gz_path, tar_path = _layer(tmp_path, 3 * core.CHUNK_SIZE)
+    pipeline = core.DecompressPipeline(workers=2, max_pending=2)
+    try:
+        stream = core.LayerStream(digest, gz_path, tar_path, pipeline)
+        for offset in range(0, len(data), 1000):
+            stream.update(data[offset:offset + 1000])
+        diff_id = stream.finish()
+    finally:
+        pipeline.shutdown()
+    assert diff_id == f"sha256:{hashlib.sha256(raw).hexdigest()}"
+    with open(tar_path, 'rb') as f:
+        assert f.read() == raw
+
+def test_pipeline_shutdown_mid_stream_does_not_block(tmp_path):
+    _, data, digest, gz_path, tar_path = _layer(tmp_path, 4 * core.CHUNK_SIZE)
+    pipeline = core.DecompressPipeline(workers=1, max_pending=2)
+    stream = core.LayerStream(digest, gz_path, tar_path, pipeline)
+    half = len(data) // 2
+    stream.update(data[:half])
+    pipeline.shutdown()
+    with pytest.raises(RuntimeError):
+        stream.update(data[half:])
+
+    closer = threading.Thread(target=stream.close)
+    closer.start()
+    closer.join(5)
+    assert not closer.is_alive()
+    with pytest.raises(RuntimeError):
+        stream.wait()
@@ -0,0 +1,52 @@
+import pytest
+
+from docker_pull import core
+
+def _entry(digest, architecture, os_name="linux", variant=None):
+    platform = {'os': os_name, 'architecture': architecture}
+    if variant:
+        platform['variant'] = variant
+    return {'digest': digest, 'platform': platform}
+
+# 多架构镜像索引：arm64 未写 variant，末尾带有 unknown/unknown 的构建证明清单
+INDEX = {'manifests': [
+    _entry("sha256:amd64", "amd64"),
+    _entry("sha256:arm64", "arm64"),
+    _entry("sha256:armv6", "arm", variant="v6"),
+    _entry("sha256:armv7", "arm", variant="v7"),
+    _entry("sha256:windows", "amd64", os_name="windows"),
+    _entry("sha256:attestation", "unknown", os_name="unknown"),
+]}
+
+def test_parse_platforms():
+    assert core.parse_platforms("amd64, arm64/v8,linux/arm/v7") == [
+        {'os': 'linux', 'architecture': 'amd64', 'variant': None},
+        {'os': 'linux', 'architecture': 'arm64', 'variant': 'v8'},
+        {'os': 'linux', 'architecture': 'arm', 'variant': 'v7'},
+    ]
+    assert core.parse_platforms(" ALL ") is None
+
+@pytest.mark.parametrize("value", ["", ",", " , ", "linux/", "linux"])
+def test_parse_platforms_rejects_empty(value):
+    with pytest.raises(ValueError):
+        core.parse_platforms(value)
+
+@pytest.mark.parametrize("value, digests", [
+    ("amd64", ["sha256:amd64"]),
+    ("arm64/v8", ["sha256:arm64"]),
+    ("arm", ["sha256:armv6"]),
+    ("arm/v7", ["sha256:armv7"]),
+    ("arm/v7,amd64,linux/amd64", ["sha256:armv7", "sha256:amd64"]),
+])
+def test_select_platforms(value, digests):
+    selected = core._select_platforms(INDEX, core.parse_platforms(value))
+    assert [m['digest'] for m in selected] == digests
+
+def test_select_all_skips_attestations_and_other_os():
+    selected = core._select_platforms(INDEX, None)
+    assert [m['digest'] for m in selected] == ["sha256:amd64", "sha256:arm64", "sha256:armv6", "sha256:armv7"]
+
+@pytest.mark.parametrize("value", ["arm64/v9", "riscv64", "arm/v5"])
+def test_select_missing_platform(value):
+    with pytest.raises(ValueError):
+        core._select_platforms(INDEX, core.parse_platforms(value))
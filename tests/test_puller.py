@@ -0,0 +1,28 @@
+import json
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+from docker_pull import core
+from conftest import IMAGE
+
+def test_pull_builds_archive(puller, tmp_path):
+    output_path = str(tmp_path / "bench.tar")
+    puller.pull(IMAGE, output_path, package_format="docker")
+    with tarfile.open(output_path) as tar:
+        manifest = json.load(tar.extractfile("manifest.json"))
+    assert manifest[0]['RepoTags'] == ["library/bench:latest"]
+    assert len(manifest[0]['Layers']) == 6
+
+def test_concurrent_fetch_blob_records_every_layer(puller, tmp_path):
+    layers = puller.resolve(IMAGE)[0]['manifest']['layers']
+    blobs_dir = str(tmp_path / "blobs")
+    with ThreadPoolExecutor(max_workers=len(layers)) as executor:
+        paths = list(executor.map(
+            lambda layer: puller.fetch_blob(IMAGE, layer, blobs_dir, decompress=True), layers
+        ))
+    assert all(os.path.exists(path) for path in paths)
+    with open(os.path.join(blobs_dir, core.LAYER_INDEX_FILE), 'r', encoding='utf-8') as f:
+        recorded = json.load(f)['layers']
+    assert set(recorded) == {layer['digest'] for layer in layers}
+    assert not [name for name in os.listdir(blobs_dir) if name.endswith(".tmp")]
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+import docker_pull
+from docker_pull import core
+from conftest import IMAGE, registry_address
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+def test_reserve_refills_at_rate(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(core.time, "monotonic", clock)
+    limiter = core.RateLimiter(1000, burst=500)
+
+    assert limiter.reserve(500) == 0.0
+    # 额度用尽后按速率计算等待时间，额度可以为负
+    assert limiter.reserve(250) == 0.25
+    assert limiter.reserve(250) == 0.5
+    clock.now += 0.5
+    assert limiter.reserve(250) == 0.25
+    # 长时间空闲后额度不超过突发上限
+    clock.now += 60
+    assert limiter.reserve(500) == 0.0
+    assert limiter.reserve(1) == 0.001
+
+def test_consume_caps_throughput_across_threads():
+    rate = 64 * 1024
+    limiter = core.RateLimiter(rate, burst=8 * 1024)
+    chunk = 4 * 1024
+    # 4 个线程共享同一个限速器，总计 32KB 超出突发额度的部分至少需要 0.375 秒
+    threads = [threading.Thread(target=lambda: [limiter.consume(chunk) for _ in range(8)]) for _ in range(4)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - started >= (4 * 8 * chunk - 8 * 1024) / rate * 0.95
+
+def test_consume_async_caps_throughput():
+    rate = 64 * 1024
+    limiter = core.RateLimiter(rate, burst=8 * 1024)
+
+    async def consume():
+        await asyncio.gather(*(limiter.consume_async(4 * 1024) for _ in range(8)))
+
+    started = time.monotonic()
+    asyncio.run(consume())
+    assert time.monotonic() - started >= (8 * 4 * 1024 - 8 * 1024) / rate * 0.95
+
+def test_puller_limit_rate(registry, tmp_path):
+    rate = 256 * 1024
+    telemetry = core.Telemetry()
+    with docker_pull.Puller(registry_address(registry), work_dir=str(tmp_path), verify=False,
+                            limit_rate=rate, telemetry=telemetry) as puller:
+        burst = puller.session.rate_limiter.capacity
+        started = time.monotonic()
+        puller.pull(IMAGE, str(tmp_path / "bench.tar"), package_format="docker")
+        elapsed = time.monotonic() - started
+    downloaded = telemetry.snapshot()['downloaded']
+    assert downloaded > burst
+    assert elapsed >= (downloaded - burst) / rate * 0.95
@@ -0,0 +1,74 @@
+# 分段下载：多个分段并发写入预分配文件，已完成的连续前缀按顺序读回校验与解压
+import glob
+import hashlib
+import json
+import os
+import tarfile
+import threading
+
+import pytest
+
+import docker_pull
+from docker_pull import core
+from conftest import IMAGE, registry_address
+
+# 分段边界不落在读缓冲区（8KB）的整数倍上
+UNALIGNED_SEGMENT_SIZE = 10007
+
+def test_unaligned_segments(registry, tmp_path):
+    output_path = str(tmp_path / "bench.tar")
+    with docker_pull.Puller(registry_address(registry), work_dir=str(tmp_path), verify=False,
+                            segment_size=UNALIGNED_SEGMENT_SIZE, segment_workers=4) as puller:
+        puller.pull(IMAGE, output_path, package_format="docker")
+    with tarfile.open(output_path) as tar:
+        assert "manifest.json" in tar.getnames()
+
+def test_unaligned_segments_async(registry, tmp_path):
+    pytest.importorskip("aiohttp")
+    repo, img, _ = core.parse_image_input(IMAGE)
+    manifest = json.loads(registry.manifest)
+    layers_dir = str(tmp_path)
+    layer_index = core.LayerIndex(layers_dir)
+    core.download_layer_jobs_async(
+        registry_address(registry), [(repo, img, layer) for layer in manifest['layers']], layers_dir,
+        layer_index, segment_size=UNALIGNED_SEGMENT_SIZE, verify=False
+    )
+    for layer in manifest['layers']:
+        entry = layer_index.layers[layer['digest']]
+        with open(os.path.join(layers_dir, entry['file']), 'rb') as f:
+            assert f"sha256:{hashlib.sha256(f.read()).hexdigest()}" == entry['diff_id']
+
+def test_segment_size_must_be_positive():
+    with pytest.raises(ValueError):
+        docker_pull.Puller(segment_size=0)
+
+def test_segmented_download_resumes_from_journal(slow_registry, session, tmp_path):
+    repo, img, _ = core.parse_image_input(IMAGE)
+    layer = json.loads(slow_registry.manifest)['layers'][0]
+    address = registry_address(slow_registry)
+    layers_dir = str(tmp_path)
+    options = dict(segment_size=64 * 1024 + 7, segment_workers=4)
+
+    stop = threading.Event()
+    timer = threading.Timer(1.0, stop.set)
+    timer.start()
+    try:
+        with pytest.raises(core.DownloadCancelled):
+            core.download_layer(session, address, repo, img, layer, layers_dir, None,
+                                layer_index=core.LayerIndex(layers_dir), stop=stop, **options)
+    finally:
+        timer.cancel()
+    [journal_path] = glob.glob(os.path.join(layers_dir, "*.journal"))
+    journal = core.SegmentJournal.load(journal_path, layer['digest'])
+    done = sum(end + 1 - start for start, end in journal.done)
+    assert 0 < done < layer['size']
+
+    # 续传只下载日志中未完成的分段
+    session.telemetry = core.Telemetry()
+    layer_index = core.LayerIndex(layers_dir)
+    core.download_layer(session, address, repo, img, layer, layers_dir, None, layer_index=layer_index, **options)
+    assert session.telemetry.downloaded <= layer['size'] - done
+    assert not glob.glob(os.path.join(layers_dir, "*.journal"))
+    entry = layer_index.layers[layer['digest']]
+    with open(os.path.join(layers_dir, entry['file']), 'rb') as f:
+        assert f"sha256:{hashlib.sha256(f.read()).hexdigest()}" == entry['diff_id']
@@ -0,0 +1,84 @@
+import json
+import os
+import socket
+import socketserver
+import tarfile
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from docker_pull import core
+from conftest import IMAGE
+
+# 每种格式归档中特有的文件
+FORMAT_MARKERS = {"synology": "repositories", "oci": "oci-layout", "docker": "manifest.json"}
+
+def test_formats_of_same_image_write_distinct_outputs(puller, tmp_path):
+    service = core.PullService(puller, str(tmp_path / "out"), str(tmp_path / "work"))
+    try:
+        jobs = [service.submit({'image': IMAGE, 'format': package_format})[0] for package_format in FORMAT_MARKERS]
+        for job in jobs:
+            assert job.done.wait(60)
+    finally:
+        service.close()
+
+    assert [job.state for job in jobs] == ["done"] * len(jobs), [job.error for job in jobs]
+    assert len({job.output_path for job in jobs}) == len(jobs)
+    for job, marker in zip(jobs, FORMAT_MARKERS.values()):
+        with tarfile.open(job.output_path) as tar:
+            assert marker in tar.getnames()
+
+def test_unix_server_keeps_regular_file(tmp_path):
+    path = tmp_path / "not-a-socket"
+    path.write_text("data")
+    with pytest.raises(ValueError):
+        core.create_server(f"unix:{path}", None)
+    assert path.read_text() == "data"
+
+def test_unix_server_replaces_stale_socket(tmp_path):
+    path = str(tmp_path / "pull.sock")
+    for _ in range(2):
+        server = core.create_server(f"unix:{path}", None)
+        server.server_close()
+    assert os.path.exists(path)
+
+def test_tcp_server_without_unix_sockets(monkeypatch):
+    # Windows 上 socket 没有 AF_UNIX，socketserver 也不定义 UnixStreamServer
+    monkeypatch.delattr(socket, "AF_UNIX")
+    monkeypatch.delattr(socketserver, "UnixStreamServer")
+    server = core.create_server("127.0.0.1:0", None)
+    server.server_close()
+    with pytest.raises(ValueError):
+        core.create_server("unix:/tmp/docker_pull_test.sock", None)
+
+@pytest.mark.parametrize("body", [
+    {'image': IMAGE, 'output': 5},
+    {'image': IMAGE, 'output': ""},
+    {'image': IMAGE, 'arch': 5},
+    {'image': IMAGE, 'arch': "linux/"},
+    {'image': IMAGE, 'output': "layers/layers.json"},
+    {'image': IMAGE, 'output': "../escape.tar"},
+    {'image': IMAGE, 'format': "zip"},
+    {'arch': "amd64"},
+])
+def test_invalid_job_requests_are_rejected(puller, tmp_path, body):
+    output_dir = tmp_path / "out"
+    service = core.PullService(puller, str(output_dir), str(output_dir / "layers"))
+    server = core.create_server("127.0.0.1:0", service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{server.server_address[1]}/jobs", data=json.dumps(body).encode(), method="POST"
+        )
+        with pytest.raises(urllib.error.HTTPError) as error:
+            # 不经过环境变量中的代理
+            urllib.request.build_opener(urllib.request.ProxyHandler({})).open(request, timeout=10)
+        assert error.value.code == 400
+        assert json.load(error.value)['error']
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+    assert not service.jobs
@@ -0,0 +1,83 @@
+# 增量同步：清单摘要未变化时跳过，变化时从上次的归档取回未变化的层，只下载新增的层
+import hashlib
+import logging
+import os
+import sys
+import tarfile
+
+import pytest
+
+import benchmark
+from docker_pull import cli, core
+from conftest import IMAGE, registry_address, start_registry
+
+LAYER_SIZE = 64 * 1024
+
+@pytest.fixture
+def own_registry(cert):
+    # 测试中会替换清单，不与其他测试共用
+    server = start_registry(cert, layers=2, layer_size=LAYER_SIZE)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def sync(own_registry, tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.INFO, logger=core.logger.name)
+    output_dir = tmp_path / "output"
+
+    def run(package_format="docker"):
+        caplog.clear()
+        monkeypatch.setattr(sys, "argv", [
+            "main.py", IMAGE, "--sync", "-r", registry_address(own_registry), "-o", str(output_dir),
+            "-f", package_format, "--insecure", "--no-token-cache", "--progress", "none"
+        ])
+        cli.main()
+        assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+        return str(output_dir / "library_bench_latest.tar"), caplog.text
+
+    return run
+
+def _replace_image(server, layers):
+    # 同一种子生成的合成镜像前几层相同，多一层即模拟镜像更新后只新增一层
+    blobs, manifest = benchmark.synthetic_image(layers, LAYER_SIZE, seed=0)
+    server.blobs.update(blobs)
+    server.manifest = manifest
+    server.manifest_digest = f"sha256:{hashlib.sha256(manifest).hexdigest()}"
+
+def test_sync_skips_current_archive(sync):
+    output_path, _ = sync()
+    assert os.path.exists(f"{output_path}{core.SYNC_STATE_SUFFIX}")
+    mtime = os.stat(output_path).st_mtime_ns
+
+    _, log = sync()
+    assert "所有镜像均已是最新" in log
+    assert os.stat(output_path).st_mtime_ns == mtime
+
+@pytest.mark.parametrize("package_format", ["docker", "oci"])
+def test_sync_reuses_unchanged_layers(sync, own_registry, package_format):
+    sync(package_format)
+    _replace_image(own_registry, layers=3)
+
+    output_path, log = sync(package_format)
+    assert "复用 2 个未变化的层/配置" in log
+    assert "共需要下载 3 个镜像层" in log
+    state = core.read_sync_state(output_path)
+    assert state['images'][0]['digest'] == own_registry.manifest_digest
+    with tarfile.open(output_path) as tar:
+        for entry in state['blobs'].values():
+            assert tar.getmember(entry['member'])
+
+def test_restore_skips_corrupt_members(sync, tmp_path):
+    output_path, _ = sync()
+    state = core.read_sync_state(output_path)
+    digests = list(state['blobs'])
+    state['blobs'][digests[0]]['diff_id'] = "sha256:" + "0" * 64
+    work_dir = str(tmp_path / "work")
+    os.makedirs(work_dir)
+    layer_index = core.LayerIndex(work_dir)
+
+    restored = core.restore_from_archive(output_path, state, digests, work_dir, layer_index)
+    assert restored == set(digests[1:])
+    assert digests[0] not in layer_index.layers
+    assert not [name for name in os.listdir(work_dir) if name.endswith(".download")]
@@ -0,0 +1,42 @@
+# 归档写入：层文件由内核直接拷贝进输出归档，结果须能被标准 tarfile 读取
+import hashlib
+import json
+import os
+import tarfile
+
+import pytest
+
+from docker_pull import core
+from conftest import IMAGE
+
+@pytest.mark.parametrize("copy_method", [None, "sendfile", "copyfileobj"])
+def test_tar_stream_writer_roundtrip(tmp_path, copy_method):
+    layer = os.urandom(3 * core.CHUNK_SIZE + 123)
+    layer_path = tmp_path / "layer.tar"
+    layer_path.write_bytes(layer)
+    output_path = str(tmp_path / "image.tar")
+    with core.TarStreamWriter(output_path) as tar:
+        tar.copy_method = copy_method
+        tar.add_dir("abc")
+        tar.add_file("abc/layer.tar", str(layer_path))
+        tar.add_bytes("manifest.json", b'[]')
+        tar.add_bytes("empty", b'')
+
+    assert os.path.getsize(output_path) % tarfile.RECORDSIZE == 0
+    with tarfile.open(output_path) as archive:
+        assert archive.getnames() == ["abc", "abc/layer.tar", "manifest.json", "empty"]
+        assert archive.getmember("abc").isdir()
+        assert archive.extractfile("abc/layer.tar").read() == layer
+        assert archive.extractfile("manifest.json").read() == b'[]'
+        assert archive.extractfile("empty").read() == b''
+
+def test_built_layers_match_config_diff_ids(puller, tmp_path):
+    output_path = str(tmp_path / "bench.tar")
+    puller.pull(IMAGE, output_path, package_format="docker")
+    with tarfile.open(output_path) as archive:
+        manifest = json.load(archive.extractfile("manifest.json"))[0]
+        config = json.load(archive.extractfile(manifest['Config']))
+        diff_ids = [
+            f"sha256:{hashlib.sha256(archive.extractfile(name).read()).hexdigest()}" for name in manifest['Layers']
+        ]
+    assert diff_ids == config['rootfs']['diff_ids']